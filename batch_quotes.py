@@ -0,0 +1,358 @@
+"""
+Regenerate quotes for many Jira issues at once.
+
+    python batch_quotes.py --jql "project = QUOTE AND status = 'Open'"
+    python batch_quotes.py --keys-file issues.txt --workers 4 --upload-workers 8
+    python batch_quotes.py --jql "..." --state batch_state.json   # run again to resume
+
+Each issue is turned into the same payload the Jira automation sends (see Webhook JSON).
+Documents are rendered and converted to PDF on a pool of processes, then uploaded and
+attached through the normal quote pipeline on a bounded number of threads. Progress is
+written to the state file after every issue, so an interrupted batch picks up where it
+stopped: finished issues are skipped and unfinished jobs resume from their checkpoints.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime
+
+import flaskapp_script
+from config import JIRA_URL, JOB_LEASE, JOB_WORKERS, PDF_CONVERTER, CONVERTER_TIMEOUT, CONVERTER_MAX_JOBS, SOFFICE_PATH
+from config import OPTIMIZE_OUTPUTS, OPTIMIZE_MAX_IMAGE_PIXELS, OPTIMIZE_JPEG_QUALITY
+from document_optimizer import optimize_docx, optimize_pdf
+from flaskapp_script import (QuoteJob, TemplateSkeleton, convert_bytes_to_pdf, extract_items, fetch_template_skeleton,
+                             jira_session, job_store, output_cache, output_options, record_bytes_saved,
+                             render_quote_document, run_quote_job)
+from output_cache import output_key
+from job_store import UNFINISHED_STATUSES
+from pdf_converters import create_converter
+
+WEBHOOK_TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Webhook JSON')
+SMART_VALUE_PATTERN = re.compile(r'^\{\{issue\.(.+)\}\}$')
+SEARCH_PAGE_SIZE = 100
+
+
+## Payloads from Jira issues ##
+# The field mapping is read from Webhook JSON so the batch and the automation rule build
+# the same payload. A smart value such as {{issue.fields.customfield_11010.Name}} becomes
+# the path ['fields', 'customfield_11010', 'Name'] into the issue returned by the REST API.
+def load_field_map(path=WEBHOOK_TEMPLATE_PATH):
+    with open(path, encoding='utf-8') as template_file:
+        template = json.load(template_file)['issue']
+    field_map = {}
+    for key, smart_value in template.items():
+        match = SMART_VALUE_PATTERN.match(smart_value.strip())
+        if match:
+            field_map[key] = match.group(1).split('.')
+    return field_map
+
+def requested_fields(field_map):
+    return sorted({path[1] for path in field_map.values() if path[0] == 'fields' and len(path) > 1})
+
+def resolve_field(value, path):
+    for name in path:
+        if isinstance(value, list):
+            value = [resolve_field(entry, [name]) for entry in value]
+            value = [entry for entry in value if entry not in (None, '')]
+        elif isinstance(value, dict):
+            value = value.get(name)
+        else:
+            return None
+        if value is None:
+            return None
+    return value
+
+def smart_value_text(value):
+    # Render a field value the way a Jira smart value prints it
+    if value is None:
+        return ''
+    if isinstance(value, dict):
+        for name in ('value', 'name', 'displayName', 'text'):
+            if name in value:
+                return smart_value_text(value[name])
+        return json.dumps(value)
+    if isinstance(value, list):
+        return ', '.join(smart_value_text(entry) for entry in value)
+    return str(value)
+
+def issue_payload(issue, field_map):
+    return {key: smart_value_text(resolve_field(issue, path)) for key, path in field_map.items()}
+
+def search_issues(jql, fields):
+    url = f"{JIRA_URL}/rest/api/3/search/jql"
+    next_page_token = None
+    while True:
+        body = {"jql": jql, "fields": fields, "maxResults": SEARCH_PAGE_SIZE}
+        if next_page_token:
+            body["nextPageToken"] = next_page_token
+        response = jira_session.post(url, json=body)
+        response.raise_for_status()
+        page = response.json()
+        yield from page.get('issues', [])
+        next_page_token = page.get('nextPageToken')
+        if page.get('isLast', True) or not next_page_token:
+            return
+
+def issues_by_key(keys, fields):
+    # Look the keys up in chunks rather than one request per issue
+    found = {}
+    for start in range(0, len(keys), SEARCH_PAGE_SIZE):
+        chunk = keys[start:start + SEARCH_PAGE_SIZE]
+        for issue in search_issues(f"key in ({', '.join(chunk)}) ORDER BY key", fields):
+            found[issue['key']] = issue
+    missing = [key for key in keys if key not in found]
+    return [found[key] for key in keys if key in found], missing
+
+def read_keys(path):
+    with open(path, encoding='utf-8') as keys_file:
+        keys = [line.split('#', 1)[0].strip() for line in keys_file]
+    return list(dict.fromkeys(key for key in keys if key))
+
+
+## Batch state ##
+# One entry per issue key with its job id and status, rewritten after every issue.
+def load_state(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as state_file:
+        return json.load(state_file)
+
+def save_state(path, state):
+    if not path:
+        return
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as state_file:
+        json.dump(state, state_file, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+def prepare_job(data, entry):
+    # Resume the job from an earlier run of this batch if it was for the same payload
+    record = job_store.load(entry['job_id']) if entry else None
+    if record is not None and record['status'] != 'completed' and record['payload_hash'] == QuoteJob(data).payload_hash:
+        if (record['status'] in UNFINISHED_STATUSES and record['owner'] != flaskapp_script.INSTANCE_ID
+                and job_store.owner_alive(record['owner'], JOB_LEASE)):
+            return None
+        job_store.reset(record['id'], flaskapp_script.INSTANCE_ID, keep_checkpoints=True)
+        return QuoteJob.from_record(job_store.load(record['id']), store=job_store)
+    job = QuoteJob(data, store=job_store)
+    job.checkpoint()
+    return job
+
+
+## Render processes ##
+# Every process parses the templates the batch uses once and keeps its own converter. The
+# converter is sized to one document at a time, the process pool already provides the
+# parallelism.
+worker_templates = {}
+
+def init_render_worker(templates):
+    for version, content in templates.items():
+        worker_templates[version] = TemplateSkeleton(content)
+    flaskapp_script.pdf_converter = create_converter(PDF_CONVERTER, size=1, timeout=CONVERTER_TIMEOUT,
+                                                     max_jobs=CONVERTER_MAX_JOBS, soffice_path=SOFFICE_PATH)
+
+def render_and_convert(version, data, today_date):
+    timings = {}
+    sizes = {}  # document -> (bytes before, bytes after) the optimization
+    started = time.time()
+    try:
+        word_content, total_sum = render_quote_document(worker_templates[version], data, extract_items(data), today_date)
+    except Exception as e:
+        timings['render'] = (started, time.time(), str(e) or type(e).__name__)
+        return None, None, None, timings, sizes
+    timings['render'] = (started, time.time(), None)
+    if OPTIMIZE_OUTPUTS:
+        started = time.time()
+        optimized = optimize_docx(word_content, OPTIMIZE_MAX_IMAGE_PIXELS, OPTIMIZE_JPEG_QUALITY)
+        sizes['docx'] = (len(word_content), len(optimized))
+        word_content = optimized
+        timings['optimize_docx'] = (started, time.time(), None)
+    started = time.time()
+    pdf_content = convert_bytes_to_pdf(word_content)
+    timings['convert'] = (started, time.time(), None if pdf_content else "Failed to convert DOCX to PDF")
+    if OPTIMIZE_OUTPUTS and pdf_content:
+        started = time.time()
+        optimized = optimize_pdf(pdf_content)
+        sizes['pdf'] = (len(pdf_content), len(optimized))
+        pdf_content = optimized
+        timings['optimize_pdf'] = (started, time.time(), None)
+    return word_content, pdf_content, str(total_sum), timings, sizes
+
+def record_cached(job, cached):
+    # The documents were already rendered for this payload, template and date
+    word_content, pdf_content, meta = cached
+    now = time.time()
+    job.save_artifact('docx', word_content)
+    job.save_artifact('pdf', pdf_content)
+    job.set_output('total_sum', meta['total_sum'])
+    job.set_output('output_cache', 'hit')
+    job.record_stage('render', now, now)
+    job.record_stage('convert', now, now)
+
+def record_render(job, result):
+    word_content, pdf_content, total_sum, timings, sizes = result
+    if word_content is not None:
+        job.save_artifact('docx', word_content)
+        job.set_output('total_sum', total_sum)
+    if pdf_content is not None:
+        job.save_artifact('pdf', pdf_content)
+    for document, (size_before, size_after) in sizes.items():
+        record_bytes_saved(job, document, size_before, size_after)
+    for name in ('render', 'optimize_docx', 'convert', 'optimize_pdf'):
+        if name in timings:
+            started_at, finished_at, error = timings[name]
+            job.record_stage(name, started_at, finished_at, error)
+            if error:
+                job.fail(error)
+                return False
+    return True
+
+
+## Batch run ##
+def run_batch(issues, args):
+    field_map = load_field_map()
+    state = load_state(args.state)
+    today_date = datetime.now().strftime("%Y-%m-%d")
+    summary = {'completed': 0, 'failed': [], 'skipped': 0}
+
+    # The batch owns its jobs from the moment they are created or resumed, so the heartbeat
+    # has to run before then or a server would recover them as orphans
+    flaskapp_script.start_heartbeat()
+    jobs = []
+    for issue in issues:
+        data = issue_payload(issue, field_map)
+        entry = state.get(data['key'])
+        if entry and entry['status'] == 'completed' and not args.force:
+            summary['skipped'] += 1
+            continue
+        job = prepare_job(data, entry)
+        if job is None:
+            print(f"{data['key']}: job {entry['job_id']} is still running in another process, skipping.")
+            summary['skipped'] += 1
+            continue
+        state[data['key']] = {'job_id': job.id, 'status': job.status}
+        jobs.append(job)
+    save_state(args.state, state)
+
+    if not jobs:
+        print("Nothing to do.")
+        return summary
+
+    def finish(job):
+        state[job.issue_key] = {'job_id': job.id, 'status': job.status}
+        if job.status == 'completed':
+            summary['completed'] += 1
+        else:
+            summary['failed'].append(job)
+        save_state(args.state, state)
+        done = summary['completed'] + len(summary['failed'])
+        print(f"[{done}/{len(jobs)}] {job.issue_key}: {job.status}{f' ({job.error})' if job.error else ''}")
+
+    to_render = []
+    to_publish = []
+    versions = {}  # job id -> version of the template its issue selects
+    templates = {}  # template version -> template bytes, for the render processes
+    for job in jobs:
+        if job.is_done('render') and job.is_done('convert'):
+            to_publish.append(job)
+            continue
+        template = fetch_template_skeleton(job.data)
+        if template is None:
+            job.fail("Failed to fetch template from Confluence")
+            finish(job)
+            continue
+        versions[job.id] = template.version
+        templates[template.version] = template.content
+        to_render.append(job)
+    cache_hits = 0
+    if output_cache is not None:
+        for job in list(to_render):
+            cached = output_cache.get(output_key(job.payload_hash, versions[job.id], today_date, output_options()))
+            if cached is not None:
+                record_cached(job, cached)
+                to_render.remove(job)
+                to_publish.append(job)
+                cache_hits += 1
+    print(f"{len(jobs)} quote(s) to build, {len(to_render)} to render from {len(templates)} template(s), "
+          f"{cache_hits} from the output cache, "
+          f"{args.workers} render process(es), {args.upload_workers} upload thread(s).")
+
+    # Rendered documents wait in memory for an upload thread, so only a few are kept in flight
+    max_in_flight = args.workers * 2
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context, initializer=init_render_worker,
+                             initargs=(templates,)) as render_pool, \
+            ThreadPoolExecutor(max_workers=args.upload_workers, thread_name_prefix='batch-upload') as upload_pool:
+        publishing = {upload_pool.submit(run_quote_job, job) for job in to_publish}
+        rendering = {}
+        pending = list(reversed(to_render))
+        while pending or rendering or publishing:
+            while pending and len(rendering) < max_in_flight:
+                job = pending.pop()
+                job.status = 'running'
+                job.checkpoint()
+                rendering[render_pool.submit(render_and_convert, versions[job.id], job.data, today_date)] = job
+
+            done, _ = wait(set(rendering) | publishing, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in publishing:
+                    publishing.discard(future)
+                    finish(future.result())
+                    continue
+                job = rendering.pop(future)
+                try:
+                    rendered = record_render(job, future.result())
+                except Exception as e:
+                    print(f"Render process failed for {job.issue_key}: {e}")
+                    job.fail("Error rendering quote")
+                    rendered = False
+                if rendered:
+                    if output_cache is not None:
+                        word_content, pdf_content, total_sum, _, _ = future.result()
+                        output_cache.put(output_key(job.payload_hash, versions[job.id], today_date, output_options()),
+                                         word_content, pdf_content, {'total_sum': total_sum})
+                    publishing.add(upload_pool.submit(run_quote_job, job))
+                else:
+                    finish(job)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--jql', help="regenerate the quote of every issue this JQL query returns")
+    source.add_argument('--keys-file', help="file with one issue key per line")
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                        help="render and convert processes")
+    parser.add_argument('--upload-workers', type=int, default=JOB_WORKERS,
+                        help="quotes uploaded and attached at the same time")
+    parser.add_argument('--state', default='batch_state.json', help="progress file used to resume the batch")
+    parser.add_argument('--force', action='store_true', help="rebuild issues the state file marks as completed")
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    fields = requested_fields(load_field_map())
+    if args.jql:
+        issues, missing = list(search_issues(args.jql, fields)), []
+    else:
+        issues, missing = issues_by_key(read_keys(args.keys_file), fields)
+    for key in missing:
+        print(f"{key}: issue not found, skipping.")
+
+    summary = run_batch(issues, args)
+    elapsed = time.monotonic() - started
+    built = summary['completed'] + len(summary['failed'])
+    rate = built / elapsed * 60 if elapsed else 0
+    print(f"\nBuilt {built} quote(s) in {elapsed:.1f}s ({rate:.1f} per minute): "
+          f"{summary['completed']} completed, {len(summary['failed'])} failed, "
+          f"{summary['skipped']} skipped, {len(missing)} not found.")
+    for job in summary['failed']:
+        print(f"  {job.issue_key}  job {job.id}: {job.error}")
+    return 1 if summary['failed'] or missing else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,63 @@
+"""
+Micro-benchmark of the line-item table: render time against row count.
+
+    python bench_table_builder.py
+    python bench_table_builder.py --rows 10 100 1000 --repeat 3
+
+build_items_table() is compared with building the same table cell by cell through
+python-docx, the way the quote table used to be built.
+"""
+import argparse
+import time
+from decimal import Decimal
+
+from docx import Document
+from docx.enum.table import WD_ALIGN_VERTICAL
+from docx.enum.text import WD_ALIGN_PARAGRAPH
+
+from flaskapp_script import TABLE_HEADERS, LineItem, build_items_table, populate_table_data
+
+
+def sample_items(rows):
+    return [LineItem(f"WMS-{i:04d}", f"Sample analysis package {i}", Decimal(i % 40 + 1), "EA",
+                     Decimal(i % 90 + 10) + Decimal('0.50'), Decimal(10))
+            for i in range(1, rows + 1)]
+
+def cell_by_cell_table(document, items):
+    table = document.add_table(rows=1, cols=len(TABLE_HEADERS))
+    table.style = 'Table Grid'
+    for idx, header in enumerate(TABLE_HEADERS):
+        table.rows[0].cells[idx].text = header
+    for values in populate_table_data(items)[0]:
+        row = table.add_row().cells
+        for idx, value in enumerate(values):
+            row[idx].text = value
+            row[idx].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
+            row[idx].vertical_alignment = WD_ALIGN_VERTICAL.CENTER
+    return table
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[5, 25, 100, 250, 500, 1000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'rows':>6} {'builder ms':>12} {'cell by cell ms':>16} {'speedup':>8}")
+    for rows in args.rows:
+        items = sample_items(rows)
+        document = Document()
+        builder = best_of(args.repeat, lambda: build_items_table(document, items))
+        cell_by_cell = best_of(args.repeat, lambda: cell_by_cell_table(document, items))
+        print(f"{rows:>6} {builder * 1000:>12.2f} {cell_by_cell * 1000:>16.2f} {cell_by_cell / builder:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
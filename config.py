@@ -20,3 +20,74 @@ SP_TENANT_ID = 'tenant id'
 
 SHAREPOINT_SITE_ID = 'your sharepoint site id'
 DOCUMENT_PATH = 'your document path'
+
+# Quote templates on Confluence, chosen by payload fields. The first rule whose 'match'
+# fields all equal the payload's (case-insensitive, a list accepts any of its values) is
+# used, so keep the default template last with an empty 'match'.
+TEMPLATES = [
+    # {'match': {'clientCode': 'ACME'}, 'page_id': '3481468945', 'title': 'Acme Quote Template.docx'},
+    # {'match': {'language': ['es', 'es-MX']}, 'page_id': '3481468945', 'title': 'Plantilla de Cotizacion.docx'},
+    {'match': {}, 'page_id': '3481468945', 'title': 'New Quote Template.docx'},
+]
+TEMPLATE_CACHE_SIZE = 8  # templates kept downloaded and parsed, per process
+TEMPLATE_CACHE_TTL = 300  # seconds before the cached Confluence template is checked for a new version
+CONFLUENCE_TIMEOUT = 10
+
+TOKEN_EXPIRY_MARGIN = 120  # treat the Graph token as expired this many seconds early
+TOKEN_PROACTIVE_REFRESH = 300  # fetch the next Graph token in the background this long before that
+
+HTTP_POOL_SIZE = 10  # keep-alive connections per host, should cover IO_WORKERS
+
+ASYNC_JOB_MODE = False  # when True /jira answers 202 with a job id and the quote is built in the background
+JOB_WORKERS = 4
+JOB_QUEUE_LIMIT = 50
+JOB_RETENTION = 7 * 24 * 3600  # seconds a completed job is kept, failed jobs are kept until replayed
+FAILED_JOB_ARTIFACT_RETENTION = 14 * 24 * 3600  # seconds the documents of a failed job are kept for its replay
+JOB_DB_PATH = 'quote_jobs.sqlite3'  # webhook payloads and stage checkpoints, used to resume jobs after a crash
+JOB_HEARTBEAT_INTERVAL = 30  # seconds between heartbeats of the process owning the running jobs
+JOB_LEASE = 120  # seconds without a heartbeat before another process resumes its jobs
+
+DEDUP_WINDOW = 24 * 3600  # seconds an identical payload for the same issue is answered with the earlier job
+DEBOUNCE_SECONDS = 5  # async mode only, wait this long for further events on the same issue before rendering
+DEBOUNCE_MAX_WAIT = 30
+
+PDF_CONVERTER = 'docx2pdf'  # 'docx2pdf' (Windows + Word), 'libreoffice' (pool of warm soffice processes) or 'soffice'
+CONVERTER_WORKERS = 2  # soffice processes kept running by the 'libreoffice' converter
+CONVERTER_TIMEOUT = 60  # seconds, a worker that takes longer is killed and replaced
+CONVERTER_MAX_JOBS = 200  # documents a worker converts before it is recycled
+SOFFICE_PATH = 'soffice'
+
+IO_WORKERS = 8  # concurrent SharePoint/Jira calls shared by all quotes
+
+LOOKUP_CACHE_TTL = 6 * 3600  # seconds Jira account ids and transition ids are cached
+REVIEW_ASSIGNEE_EMAIL = 'ngalvez@yoursite.com'  # quotes under $4000 are assigned to this user for review
+
+SHAREPOINT_SIMPLE_UPLOAD_LIMIT = 4 * 1024 * 1024  # larger files are sent through a Graph upload session
+SHAREPOINT_CHUNK_SIZE = 10 * 320 * 1024  # must be a multiple of 320 KiB
+SHAREPOINT_CHUNK_RETRIES = 3  # attempts per chunk before the upload is given up
+SHAREPOINT_CHUNK_TIMEOUT = 120  # seconds
+
+# Outbound API calls, see request_scheduler.py
+RATE_LIMITS = {  # requests per second and burst allowance per host
+    'yoursite.atlassian.net': (10, 20),
+    'graph.microsoft.com': (20, 40),
+    'login.microsoftonline.com': (5, 10),
+}
+DEFAULT_RATE_LIMIT = (10, 20)  # hosts not listed above, e.g. SharePoint upload session URLs
+HTTP_MAX_RETRIES = 5  # retries of a throttled or failed call before its response is returned
+HTTP_BACKOFF_BASE = 1  # seconds, doubled on every retry and jittered
+HTTP_BACKOFF_CAP = 60
+JOB_DEADLINE = 600  # seconds a quote job may spend on API calls, including waits and retries
+HTTP_TIMEOUT = 60  # seconds a call may wait to connect or for data when the caller sets no timeout
+
+OUTPUT_CACHE_DIR = 'output_cache'  # rendered DOCX/PDF by payload, template and date, None disables the cache
+OUTPUT_CACHE_MAX_BYTES = 512 * 1024 * 1024  # least recently used outputs are removed past this size
+
+RENDER_WORKERS = 2  # processes rendering the Word documents, 0 renders on the request/job thread instead
+RENDER_TIMEOUT = 60  # seconds a render may take before its worker pool is replaced
+
+WARM_UP_ON_START = True  # fetch the template and token and start the converter and render workers before serving
+
+OPTIMIZE_OUTPUTS = False  # shrink the DOCX and PDF before upload, see document_optimizer.py
+OPTIMIZE_MAX_IMAGE_PIXELS = 2000  # longest side of an image after downsampling, needs Pillow
+OPTIMIZE_JPEG_QUALITY = 85
@@ -0,0 +1,112 @@
+import hashlib
+import io
+import threading
+import zipfile
+from collections import OrderedDict
+
+## Output size optimization ##
+# Every quote is uploaded twice to SharePoint and attached twice to Jira, so a logo or
+# letterhead in the template is stored four times per quote. Before the upload the DOCX
+# has its images downsampled and recompressed and its zip repacked at the highest deflate
+# level. It is optimized before the PDF conversion, so the PDF embeds the smaller images
+# too. The PDF itself is rewritten with compressed object streams. Both converters
+# already embed only the subset of each font the document uses.
+#
+# Pillow and pikepdf are optional and only imported here: without Pillow the images are
+# left as they are, without pikepdf the PDF is uploaded as the converter wrote it. A
+# result that is not smaller than the input is thrown away.
+IMAGE_FORMATS = {'JPEG', 'PNG'}
+IMAGE_MEMO_SIZE = 64
+
+
+class ImageMemo:
+    # The images of a quote are almost always the template's, so each one is only
+    # recompressed once and the result reused for every later quote
+    def __init__(self, size):
+        self.size = size
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._images:
+                self._images.move_to_end(key)
+            return self._images.get(key)
+
+    def put(self, key, content):
+        with self._lock:
+            self._images[key] = content
+            while len(self._images) > self.size:
+                self._images.popitem(last=False)
+
+image_memo = ImageMemo(IMAGE_MEMO_SIZE)
+
+
+def optimize_image(content, max_pixels, jpeg_quality):
+    try:
+        from PIL import Image
+    except ImportError:
+        return content
+
+    key = (hashlib.sha256(content).hexdigest(), max_pixels, jpeg_quality)
+    optimized = image_memo.get(key)
+    if optimized is not None:
+        return optimized
+
+    optimized = content
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            image_format = image.format
+            if image_format in IMAGE_FORMATS:
+                if max(image.size) > max_pixels:
+                    # The size the image is shown at is stored in the document, not in
+                    # the image, so the layout does not change
+                    image.thumbnail((max_pixels, max_pixels), Image.LANCZOS)
+                buffer = io.BytesIO()
+                if image_format == 'JPEG':
+                    image.save(buffer, 'JPEG', quality=jpeg_quality, optimize=True)
+                else:
+                    image.save(buffer, 'PNG', optimize=True)
+                if buffer.tell() < len(content):
+                    optimized = buffer.getvalue()
+    except Exception as e:
+        print(f"Could not optimize an image, keeping the original: {e}")
+    image_memo.put(key, optimized)
+    return optimized
+
+
+def optimize_docx(content, max_pixels, jpeg_quality):
+    output = io.BytesIO()
+    try:
+        with zipfile.ZipFile(io.BytesIO(content)) as source, \
+                zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED, compresslevel=9) as target:
+            # Entries are written in their original order, [Content_Types].xml stays first
+            for info in source.infolist():
+                data = source.read(info.filename)
+                if info.filename.startswith('word/media/'):
+                    data = optimize_image(data, max_pixels, jpeg_quality)
+                target.writestr(info.filename, data)
+    except Exception as e:
+        print(f"Could not optimize the DOCX, keeping the original: {e}")
+        return content
+    optimized = output.getvalue()
+    return optimized if len(optimized) < len(content) else content
+
+
+def optimize_pdf(content):
+    try:
+        import pikepdf
+    except ImportError:
+        return content
+
+    output = io.BytesIO()
+    try:
+        with pikepdf.open(io.BytesIO(content)) as pdf:
+            pdf.remove_unreferenced_resources()
+            pdf.save(output, compress_streams=True, recompress_flate=True,
+                     object_stream_mode=pikepdf.ObjectStreamMode.generate)
+    except Exception as e:
+        print(f"Could not optimize the PDF, keeping the original: {e}")
+        return content
+    optimized = output.getvalue()
+    return optimized if len(optimized) < len(content) else content
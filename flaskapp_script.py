@@ -1,30 +1,99 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, g, request, jsonify, url_for
 from docx import Document
 from datetime import datetime
-from docx.shared import Pt, RGBColor, Cm
-from docx.oxml import OxmlElement
+from docx.shared import Cm
+from docx.oxml import OxmlElement, parse_xml
+from docx.oxml.ns import nsdecls
 from docx.oxml.ns import qn
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.enum.table import WD_ALIGN_VERTICAL
-from werkzeug.utils import secure_filename
+from docx.enum.style import WD_STYLE_TYPE
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.text.paragraph import Paragraph
 import os
-from docx2pdf import convert
-from jira import JIRA
 import requests
 from requests.auth import HTTPBasicAuth
 import math 
-import pythoncom
-import tempfile
-import shutil
+import re
+import copy
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from xml.sax.saxutils import escape
 import io
-from docx2pdf import convert as docx_to_pdf_convert
+import threading
+import time
+import uuid
+import hashlib
+import json
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from config import JIRA_API_TOKEN, CONFLUENCE_API_TOKEN, SP_CLIENT_ID, SP_CLIENT_SECRET, SP_TENANT_ID
+from config import TEMPLATES, TEMPLATE_CACHE_SIZE, TEMPLATE_CACHE_TTL, CONFLUENCE_TIMEOUT
+from config import TOKEN_EXPIRY_MARGIN, TOKEN_PROACTIVE_REFRESH
+from config import HTTP_POOL_SIZE, IO_WORKERS
+from config import RATE_LIMITS, DEFAULT_RATE_LIMIT, HTTP_MAX_RETRIES, HTTP_BACKOFF_BASE, HTTP_BACKOFF_CAP, JOB_DEADLINE
+from config import HTTP_TIMEOUT
+from config import SHAREPOINT_SIMPLE_UPLOAD_LIMIT, SHAREPOINT_CHUNK_SIZE, SHAREPOINT_CHUNK_RETRIES, SHAREPOINT_CHUNK_TIMEOUT
+from config import LOOKUP_CACHE_TTL, REVIEW_ASSIGNEE_EMAIL
+from config import ASYNC_JOB_MODE, JOB_WORKERS, JOB_QUEUE_LIMIT, JOB_RETENTION, JOB_DB_PATH
+from config import JOB_HEARTBEAT_INTERVAL, JOB_LEASE, FAILED_JOB_ARTIFACT_RETENTION
+from config import DEDUP_WINDOW, DEBOUNCE_SECONDS, DEBOUNCE_MAX_WAIT
+from config import PDF_CONVERTER, CONVERTER_WORKERS, CONVERTER_TIMEOUT, CONVERTER_MAX_JOBS, SOFFICE_PATH
+from config import OUTPUT_CACHE_DIR, OUTPUT_CACHE_MAX_BYTES
+from config import RENDER_WORKERS, RENDER_TIMEOUT
+from config import WARM_UP_ON_START
+from config import OPTIMIZE_OUTPUTS, OPTIMIZE_MAX_IMAGE_PIXELS, OPTIMIZE_JPEG_QUALITY
+from document_optimizer import optimize_docx, optimize_pdf
+from job_store import JobStore, new_instance_id
+from output_cache import OutputCache, output_key
+from pdf_converters import ConversionError, create_converter
+from request_scheduler import DeadlineExecutor, RequestScheduler, ScheduledAdapter, deadline, time_left
+import metrics
 
 SHAREPOINT_SITE_ID = 'your sharepoint site id'
 DOCUMENT_PATH = 'document path'
 
+CONFLUENCE_BASE_URL = 'https://yoursite.atlassian.net/wiki'
+
 app = Flask(__name__)
 
+## Function to connect to JIRA ##
+def connect_to_jira():
+    # Directly define credentials
+    username = 'user@email.com'
+    api_token = JIRA_API_TOKEN
+    
+    # Set up basic authentication
+    auth = HTTPBasicAuth(username, api_token)
+    return auth
+
+## Shared HTTP sessions ##
+# One session per service so connections are kept alive and reused between quotes.
+# Each adapter keeps a pool of up to HTTP_POOL_SIZE connections per host, and the
+# default headers and auth are attached once here instead of on every call. All
+# sessions share one scheduler, which rate limits each host and retries throttled calls.
+request_scheduler = RequestScheduler(RATE_LIMITS, DEFAULT_RATE_LIMIT, max_retries=HTTP_MAX_RETRIES,
+                                     backoff_base=HTTP_BACKOFF_BASE, backoff_cap=HTTP_BACKOFF_CAP,
+                                     default_timeout=HTTP_TIMEOUT)
+
+def build_session(headers=None, auth=None):
+    session = requests.Session()
+    adapter = ScheduledAdapter(request_scheduler, pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if headers:
+        session.headers.update(headers)
+    session.auth = auth
+    return session
+
+jira_session = build_session({"Accept": "application/json"}, connect_to_jira())
+confluence_session = build_session({
+    'Authorization': 'Bearer ' + CONFLUENCE_API_TOKEN,
+    'Accept': 'application/json'
+})
+graph_session = build_session()
+
 @app.route('/')
 def api_root():
     return 'Welcome to the JIRA Webhook Receiver'
@@ -32,56 +101,702 @@ def api_root():
 @app.route('/jira', methods=['POST'])
 def api_jira_message():
     if request.headers.get('Content-Type', '').lower() == 'application/json':
-        data = request.json.get('issue', {})
-        items = extract_items(data)
-        
-        # Fetch the Word template from Confluence
-        template_content = fetch_confluence_template()
-        
-        if template_content:
-            access_token = get_access_token()  # Make sure this token is correctly retrieved
-            if not access_token:
-                return jsonify({"error": "Failed to retrieve access token"}), 500
-            
-            upload_result = create_word_document(data, items, template_content, access_token)
-            
-            if upload_result == "Upload successful":
-                return jsonify({"message": "Documents processed and uploaded successfully"}), 200
-            else:
-                return jsonify({"error": upload_result}), 500
+        payload = request.get_json(silent=True)
+        data = payload.get('issue') if isinstance(payload, dict) else None
+        if not isinstance(data, dict) or not data.get('key'):
+            return jsonify({"error": "Invalid payload, expected an 'issue' object with a 'key'"}), 400
+
+        job = QuoteJob(data, store=job_store)
+        with dedup_lock:
+            duplicate = None
+            if request.args.get('force', '').lower() not in ('1', 'true', 'yes'):
+                duplicate = job_store.find_duplicate(job.issue_key, job.payload_hash, time.time() - DEDUP_WINDOW)
+            if duplicate is None:
+                if ASYNC_JOB_MODE and DEBOUNCE_SECONDS > 0:
+                    job = debounce_job(job)
+                else:
+                    job.checkpoint()
+        if duplicate is not None:
+            # Jira fired the webhook again for a payload we have already seen
+            print(f"Duplicate event for {job.issue_key}, returning job {duplicate['id']}.")
+            return job_accepted_response(QuoteJob.from_record(duplicate), duplicate=True)
+
+        if ASYNC_JOB_MODE:
+            if job.status != 'debouncing' and not submit_job(job):
+                job.fail("Job queue is full")
+                return jsonify({"error": "Job queue is full, try again later"}), 503
+            return job_accepted_response(job)
+
+        run_quote_job(job)
+        if job.status == 'completed':
+            return jsonify({"message": job.result}), 200
         else:
-            return jsonify({"error": "Failed to fetch template from Confluence"}), 500
+            return jsonify({"error": job.error}), 500
     else:
         return jsonify({"error": "Invalid Content-Type, expected 'application/json'"}), 400
 
+def job_accepted_response(job, duplicate=False):
+    status_url = url_for('api_job_status', job_id=job.id)
+    body = {"job_id": job.id, "status_url": status_url}
+    if duplicate:
+        body["duplicate"] = True
+    if job.status == 'completed':
+        body["message"] = job.result
+        return jsonify(body), 200
+    return jsonify(body), 202, {"Location": status_url}
 
-def fetch_confluence_template():
-    base_url = 'https://yoursite.atlassian.net/wiki'
-    page_id = '3481468945'  # Ensure this is your correct page ID
-    headers = {
-        'Authorization': 'Bearer ' + CONFLUENCE_API_TOKEN,
-        'Accept': 'application/json'
-    }
-    api_url = f'{base_url}/rest/api/content/{page_id}/child/attachment'
-    response = requests.get(api_url, headers=headers)
-    if response.status_code == 200:
-        attachments = response.json().get('results', [])
-        for attachment in attachments:
-            if attachment['title'] == "New Quote Template.docx":
-                download_url = base_url + attachment['_links']['download']
-                response = requests.get(download_url, headers=headers)
-                if response.status_code == 200:
-                    return io.BytesIO(response.content)
-                else:
-                    print("Failed to download template:", response.status_code, response.text)
-                    return None
-        print("Template 'New Quote Template.docx' not found among attachments.")
-        return None
+@app.route('/jobs/<job_id>', methods=['GET'])
+def api_job_status(job_id):
+    record = job_store.load(job_id)
+    if record is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(QuoteJob.from_record(record).to_dict()), 200
+
+
+## Quote jobs ##
+# A job carries one webhook payload through the pipeline and records the progress of
+# every stage, so the same code runs both inline in the request and on the worker pool.
+# With a store attached every stage is checkpointed to SQLite, and a job that is run
+# again skips the stages it already completed.
+class JobError(Exception):
+    pass
+
+class QuoteJob:
+    def __init__(self, data, job_id=None, store=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.data = data
+        self.issue_key = data.get('key', 'Unknown_Key')
+        self.payload_hash = payload_hash(data)
+        self.status = 'queued'
+        self.stages = {}
+        self.outputs = {}
+        self.result = None
+        self.error = None
+        self.owner = INSTANCE_ID
+        self.created_at = time.time()
+        self.finished_at = None
+        self.store = store
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_record(cls, record, store=None):
+        job = cls(record['payload'], job_id=record['id'], store=store)
+        job.status = record['status']
+        job.stages = record['stages']
+        job.outputs = record['outputs']
+        job.payload_hash = record['payload_hash'] or job.payload_hash
+        job.result = record['result']
+        job.error = record['error']
+        job.created_at = record['created_at']
+        job.finished_at = record['finished_at']
+        return job
+
+    def checkpoint(self):
+        if self.store is not None:
+            with self._lock:
+                self.store.save(self)
+
+    def is_done(self, name):
+        return self.stages.get(name, {}).get('status') == 'completed'
+
+    @contextmanager
+    def stage(self, name):
+        with self._lock:
+            self.stages[name] = {"status": "running", "started_at": time.time()}
+        self.checkpoint()
+        try:
+            yield
+        except Exception as e:
+            with self._lock:
+                self.stages[name].update(status="failed", finished_at=time.time(), error=str(e))
+            self.checkpoint()
+            metrics.stage_duration.observe(self.stage_seconds(name), stage=name, outcome="failed")
+            raise
+        with self._lock:
+            self.stages[name].update(status="completed", finished_at=time.time())
+        self.checkpoint()
+        metrics.stage_duration.observe(self.stage_seconds(name), stage=name, outcome="completed")
+
+    def stage_seconds(self, name):
+        stage = self.stages.get(name, {})
+        if stage.get('started_at') is None or stage.get('finished_at') is None:
+            return None
+        return stage['finished_at'] - stage['started_at']
+
+    def record_stage(self, name, started_at, finished_at, error=None):
+        # Record a stage that ran outside this job's thread, e.g. in a batch render process
+        with self._lock:
+            self.stages[name] = {"status": "failed" if error else "completed",
+                                 "started_at": started_at, "finished_at": finished_at}
+            if error:
+                self.stages[name]["error"] = error
+        self.checkpoint()
+        metrics.stage_duration.observe(finished_at - started_at, stage=name, outcome="failed" if error else "completed")
+
+    def set_output(self, name, value):
+        with self._lock:
+            self.outputs[name] = value
+
+    def save_artifact(self, name, content):
+        if self.store is not None:
+            self.store.save_artifact(self.id, name, content)
+
+    def load_artifact(self, name):
+        if self.store is None:
+            return None
+        return self.store.load_artifact(self.id, name)
+
+    def complete(self, result):
+        self.status = 'completed'
+        self.result = result
+        self.finished_at = time.time()
+        self.checkpoint()
+        if self.store is not None:
+            # The documents are in SharePoint and Jira now, no need to keep them around
+            self.store.delete_artifacts(self.id)
+
+    def fail(self, error):
+        self.status = 'failed'
+        self.error = error
+        self.finished_at = time.time()
+        self.checkpoint()
+
+    def replace_payload(self, data):
+        self.data = data
+        self.payload_hash = payload_hash(data)
+        self.checkpoint()
+
+    def to_dict(self):
+        with self._lock:
+            stages = [dict(stage, name=name) for name, stage in self.stages.items()]
+        return {
+            "job_id": self.id,
+            "issue_key": self.issue_key,
+            "status": self.status,
+            "stages": stages,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
+
+# Only used to look up the issue's workflow, and the status changes when the quote moves the
+# issue to Completed, so neither counts towards the payload hash
+ROUTING_FIELDS = {'status', 'issueType'}
+
+def normalize_payload(data):
+    # Jira sends the same fields with stray whitespace and empty custom fields, neither
+    # of which changes the quote
+    normalized = {}
+    for key, value in data.items():
+        if key in ROUTING_FIELDS:
+            continue
+        if isinstance(value, str):
+            value = value.strip()
+        if value in ('', None):
+            continue
+        normalized[key] = value
+    return normalized
+
+def payload_hash(data):
+    normalized = json.dumps(normalize_payload(data), sort_keys=True, default=str)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+def prune_jobs():
+    now = time.time()
+    job_store.prune(now - JOB_RETENTION, now - FAILED_JOB_ARTIFACT_RETENTION)
+
+def run_quote_job(job):
+    job.status = 'running'
+    job.owner = INSTANCE_ID
+    start_heartbeat()
+    job.checkpoint()
+    prune_jobs()
+    started_at = time.time()
+    count_jobs('running', 1)
+    try:
+        # Jira, Confluence and Graph calls made for this job give up after JOB_DEADLINE seconds
+        with deadline(JOB_DEADLINE):
+            data = job.data
+            items = extract_items(data)
+
+            # Fetch the Word template from Confluence, unless the document was already
+            # rendered before the job was interrupted
+            template = None
+            if not job.is_done('render'):
+                with job.stage('fetch_template'):
+                    template = fetch_template_skeleton(data)
+                    if template is None:
+                        raise JobError("Failed to fetch template from Confluence")
+
+            with job.stage('access_token'):
+                access_token = get_access_token()
+                if not access_token:
+                    raise JobError("Failed to retrieve access token")
+
+            upload_result = create_word_document(data, items, template, access_token, job)
+        if upload_result == "Upload successful":
+            job.complete("Documents processed and uploaded successfully")
+        else:
+            job.fail(upload_result)
+    except JobError as e:
+        job.fail(str(e))
+    except Exception as e:
+        print(f"Error in job {job.id}: {e}")
+        job.fail("Error processing quote")
+    finally:
+        count_jobs('running', -1)
+    log_job(job, started_at)
+    return job
+
+def log_job(job, started_at):
+    # One structured line per job run with the time each stage took in this run
+    duration = time.time() - started_at
+    stages = {name: round(job.stage_seconds(name) * 1000) for name, stage in job.stages.items()
+              if stage.get('started_at', 0) >= started_at and job.stage_seconds(name) is not None}
+    metrics.job_duration.observe(duration, status=job.status)
+    metrics.jobs_finished.inc(status=job.status)
+    bytes_saved = {document: job.outputs[f'{document}_bytes_saved'] for document in ('docx', 'pdf')
+                   if f'{document}_bytes_saved' in job.outputs}
+    print(json.dumps({"event": "quote_job", "job_id": job.id, "issue_key": job.issue_key, "status": job.status,
+                      "duration_ms": round(duration * 1000), "stages_ms": stages, "bytes_saved": bytes_saved,
+                      "error": job.error}))
+
+## Background job pool ##
+# Used when ASYNC_JOB_MODE is on. At most JOB_WORKERS quotes run at once and at most
+# JOB_QUEUE_LIMIT are accepted before /jira starts answering 503.
+job_store = JobStore(JOB_DB_PATH)
+INSTANCE_ID = new_instance_id()  # owner of the jobs this process runs, see job_store.py
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='quote-job')
+job_slots = threading.BoundedSemaphore(JOB_QUEUE_LIMIT)
+
+def submit_job(job, wait=False):
+    if not job_slots.acquire(blocking=wait):
+        return False
+    count_jobs('queued', 1)
+    job_executor.submit(_run_queued_job, job)
+    return True
+
+def _run_queued_job(job):
+    count_jobs('queued', -1)
+    try:
+        run_quote_job(job)
+    finally:
+        job_slots.release()
+
+## Metrics ##
+# Jobs waiting for a worker and jobs being built, sync or async, for the /metrics gauges
+active_jobs = {'queued': 0, 'running': 0}
+active_jobs_lock = threading.Lock()
+
+def count_jobs(state, delta):
+    with active_jobs_lock:
+        active_jobs[state] += delta
+
+metrics.Gauge('quote_jobs_queued', "Quote jobs waiting for a worker", lambda: active_jobs['queued'])
+metrics.Gauge('quote_jobs_in_flight', "Quote jobs being built right now", lambda: active_jobs['running'])
+metrics.Gauge('quote_jobs_debouncing', "Issues waiting for their webhook burst to settle", lambda: len(pending_jobs))
+
+@app.route('/metrics', methods=['GET'])
+def api_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+
+@app.after_request
+def record_request_duration(response):
+    if 'request_started' in g:
+        metrics.request_duration.observe(time.monotonic() - g.request_started, endpoint=request.endpoint or 'unknown',
+                                         method=request.method, status=response.status_code)
+    return response
+
+## Deduplication and per-issue debounce ##
+# Jira automation fires the webhook on every field edit. An event whose payload matches
+# the issue's latest job, if that job has not failed and is less than DEDUP_WINDOW
+# seconds old, is answered with that job. In async mode the first event for an issue
+# also waits DEBOUNCE_SECONDS, and every event arriving in the meantime replaces its
+# payload and restarts the wait, up to DEBOUNCE_MAX_WAIT. The whole burst is then
+# rendered once, from the latest payload, under one job id.
+dedup_lock = threading.Lock()
+pending_jobs = {}
+
+def debounce_job(job):
+    # Called with dedup_lock held
+    now = time.monotonic()
+    entry = pending_jobs.get(job.issue_key)
+    if entry is not None:
+        entry['timer'].cancel()
+        entry['job'].replace_payload(job.data)
     else:
-        print(f"Failed to fetch attachments: {response.status_code} {response.text}")
+        job.status = 'debouncing'
+        job.checkpoint()
+        entry = {'job': job, 'first_seen': now}
+        pending_jobs[job.issue_key] = entry
+
+    delay = max(min(DEBOUNCE_SECONDS, entry['first_seen'] + DEBOUNCE_MAX_WAIT - now), 0)
+    entry['timer'] = threading.Timer(delay, release_debounced_job, [job.issue_key, entry])
+    entry['timer'].daemon = True
+    entry['timer'].start()
+    return entry['job']
+
+def release_debounced_job(issue_key, entry):
+    with dedup_lock:
+        # A newer event may have restarted the wait after this timer already fired
+        if pending_jobs.get(issue_key) is not entry:
+            return
+        del pending_jobs[issue_key]
+        job = entry['job']
+        job.status = 'queued'
+        job.checkpoint()
+    submit_job(job, wait=True)
+
+## Startup, warm-up and crash recovery ##
+# With WARM_UP_ON_START the template, the Graph token, the PDF converter, the render
+# workers and the Jira lookups are all fetched or started before the worker reports
+# ready on /ready, so its first quote runs at steady-state latency instead of paying for
+# all of them. Jobs left queued or running by an instance whose heartbeat is older than
+# JOB_LEASE are then resumed from their last completed stage, and the check repeats
+# every JOB_LEASE seconds. wsgi.py runs this before the app takes traffic; otherwise the
+# first request starts it in the background.
+startup_started = threading.Event()
+startup_lock = threading.Lock()
+heartbeat_started = threading.Event()
+ready = threading.Event()
+warm_up_steps = {}
+
+def recover_jobs():
+    records = job_store.claim_orphaned(INSTANCE_ID, JOB_LEASE)
+    for record in records:
+        print(f"Resuming job {record['id']} for {record['issue_key']} after restart.")
+        submit_job(QuoteJob.from_record(record, store=job_store), wait=True)
+    return len(records)
+
+def keep_recovering_jobs():
+    # A process that died just before this one started still holds a fresh heartbeat,
+    # so its jobs only become orphans once its lease has run out
+    while True:
+        try:
+            recover_jobs()
+        except Exception as e:
+            print(f"Failed to recover orphaned jobs: {e}")
+        time.sleep(JOB_LEASE)
+
+def start_heartbeat():
+    if heartbeat_started.is_set():
+        return
+    with startup_lock:
+        if heartbeat_started.is_set():
+            return
+        heartbeat_started.set()
+    job_store.heartbeat(INSTANCE_ID)
+    threading.Thread(target=send_heartbeats, daemon=True).start()
+
+def send_heartbeats():
+    while True:
+        time.sleep(JOB_HEARTBEAT_INTERVAL)
+        try:
+            job_store.heartbeat(INSTANCE_ID)
+        except Exception as e:
+            print(f"Failed to record the job heartbeat: {e}")
+
+def warm_up_step(name, step):
+    started = time.monotonic()
+    try:
+        step()
+        warm_up_steps[name] = 'ok'
+    except Exception as e:
+        warm_up_steps[name] = f"failed: {e}"
+        print(f"Warm-up step {name} failed: {e}")
+    print(f"Warm-up step {name} took {time.monotonic() - started:.2f}s")
+
+def start_converter():
+    pdf_converter.start()
+    if not pdf_converter.health_check():
+        raise ConversionError(f"PDF converter '{pdf_converter.name}' is not healthy")
+
+def start_render_workers():
+    if render_pool is not None:
+        template = fetch_template_skeleton({})
+        if template is None:
+            raise JobError("No default template to start the render workers with")
+        render_pool.start(template)
+
+def warm_up():
+    # A failed step is logged and left for the first quote to retry
+    warm_up_step('templates', template_registry.warm)
+    warm_up_step('graph_token', get_access_token)
+    warm_up_step('converter', start_converter)
+    warm_up_step('render_workers', start_render_workers)
+    warm_up_step('jira_lookups', warm_lookup_caches)
+
+def start_up():
+    with startup_lock:
+        if startup_started.is_set():
+            return
+        startup_started.set()
+    start_heartbeat()
+    if WARM_UP_ON_START:
+        warm_up()
+    ready.set()
+    threading.Thread(target=keep_recovering_jobs, daemon=True).start()
+
+@app.before_request
+def run_startup_tasks_once():
+    if not startup_started.is_set():
+        threading.Thread(target=start_up, daemon=True).start()
+
+@app.route('/ready', methods=['GET'])
+def api_ready():
+    return jsonify({"ready": ready.is_set(), "steps": warm_up_steps}), 200 if ready.is_set() else 503
+
+
+## Confluence template cache ##
+# The template only changes when someone uploads a new version of the attachment, so the
+# last downloaded copy is kept together with its attachment id and version. Once the TTL
+# has passed the attachment listing is checked again in the background and the file is
+# only downloaded when the version has moved. If Confluence is slow or down the last good
+# copy keeps being served.
+class TemplateCache:
+    def __init__(self, page_id, title, ttl):
+        self.page_id = page_id
+        self.title = title
+        self.ttl = ttl
+        self.attachment_id = None
+        self.version = None
+        self.skeleton = None  # the parsed template, it also holds the downloaded bytes
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+
+    def is_stale(self):
+        return time.monotonic() - self.checked_at >= self.ttl
+
+    def revalidate(self):
+        with self._lock:
+            cached = self.skeleton is not None
+            start_background = cached and self.is_stale() and not self._refreshing
+            if start_background:
+                self._refreshing = True
+
+        if not cached:
+            # Nothing cached yet, the first request has to wait for the download
+            self.refresh()
+        elif start_background:
+            threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def get_skeleton(self):
+        self.revalidate()
+        return self.skeleton
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def refresh(self):
+        with self._refresh_lock:
+            # Another thread may have refreshed the template while we were waiting
+            if self.skeleton is not None and not self.is_stale():
+                return
+
+            api_url = f'{CONFLUENCE_BASE_URL}/rest/api/content/{self.page_id}/child/attachment'
+            params = {'filename': self.title, 'expand': 'version'}
+            try:
+                response = confluence_session.get(api_url, params=params, timeout=CONFLUENCE_TIMEOUT)
+            except requests.RequestException as e:
+                print(f"Failed to fetch attachments: {e}")
+                self._mark_checked()
+                return
+
+            if response.status_code != 200:
+                print(f"Failed to fetch attachments: {response.status_code} {response.text}")
+                self._mark_checked()
+                return
+
+            attachment = None
+            for result in response.json().get('results', []):
+                if result['title'] == self.title:
+                    attachment = result
+                    break
+            if attachment is None:
+                print(f"Template '{self.title}' not found among attachments.")
+                self._mark_checked()
+                return
+
+            attachment_id = attachment['id']
+            version = attachment.get('version', {}).get('number')
+            if self.skeleton is not None and attachment_id == self.attachment_id and version == self.version:
+                # Same attachment and version as the cached copy, no need to download it again
+                self._mark_checked()
+                return
+
+            download_url = CONFLUENCE_BASE_URL + attachment['_links']['download']
+            try:
+                response = confluence_session.get(download_url, timeout=CONFLUENCE_TIMEOUT)
+            except requests.RequestException as e:
+                print(f"Failed to download template: {e}")
+                self._mark_checked()
+                return
+
+            if response.status_code != 200:
+                print("Failed to download template:", response.status_code, response.text)
+                self._mark_checked()
+                return
+
+            # Parse the new version before it replaces the cached one, so a broken upload
+            # leaves the last good template in service
+            try:
+                skeleton = TemplateSkeleton(response.content)
+            except Exception as e:
+                print(f"Failed to parse template version {version}: {e}")
+                self._mark_checked()
+                return
+
+            with self._lock:
+                self.attachment_id = attachment_id
+                self.version = version
+                self.skeleton = skeleton
+                self.checked_at = time.monotonic()
+            print(f"Template '{self.title}' cached (attachment {attachment_id}, version {version}).")
+
+    def _mark_checked(self):
+        # Only back off when there is a good copy to fall back on, otherwise the next
+        # request should try Confluence again straight away
+        if self.skeleton is not None:
+            with self._lock:
+                self.checked_at = time.monotonic()
+
+
+## Template registry ##
+# TEMPLATES in config.py maps payload fields (clientCode, product line, language, ...)
+# to a template attachment. The first rule whose fields all match the payload wins, so
+# the default template goes last with no fields. Each template has its own TemplateCache,
+# so it is downloaded and parsed once per version however many templates there are, and
+# only the most recently used TEMPLATE_CACHE_SIZE of them are kept in memory.
+class TemplateRegistry:
+    def __init__(self, rules, size, ttl):
+        self.rules = rules
+        self.size = size
+        self.ttl = ttl
+        self._caches = OrderedDict()  # (page id, title) -> TemplateCache, least recently used first
+        self._lock = threading.Lock()
+
+    def select(self, data):
+        for rule in self.rules:
+            if all(rule_matches(data.get(field), expected) for field, expected in rule.get('match', {}).items()):
+                return rule['page_id'], rule['title']
         return None
+
+    def cache_for(self, page_id, title):
+        with self._lock:
+            cache = self._caches.get((page_id, title))
+            if cache is None:
+                cache = self._caches[(page_id, title)] = TemplateCache(page_id, title, self.ttl)
+                while len(self._caches) > self.size:
+                    self._caches.popitem(last=False)
+            else:
+                self._caches.move_to_end((page_id, title))
+            return cache
+
+    def get_cache(self, data):
+        selected = self.select(data)
+        if selected is None:
+            print(f"No template in TEMPLATES matches issue {data.get('key', 'Unknown_Key')}.")
+            return None
+        return self.cache_for(*selected)
+
+    def warm(self):
+        # Downloads the configured templates, default first, up to the number the registry keeps
+        templates = list(dict.fromkeys((rule['page_id'], rule['title']) for rule in reversed(self.rules)))
+        for page_id, title in reversed(templates[:self.size]):
+            self.cache_for(page_id, title).get_skeleton()
+
+def rule_matches(value, expected):
+    # A rule value may be a single value or a list of accepted values
+    accepted = expected if isinstance(expected, (list, tuple, set)) else [expected]
+    return value is not None and str(value).strip().lower() in {str(item).strip().lower() for item in accepted}
+
+template_registry = TemplateRegistry(TEMPLATES, TEMPLATE_CACHE_SIZE, TEMPLATE_CACHE_TTL)
+
+def fetch_template_skeleton(data):
+    cache = template_registry.get_cache(data)
+    return cache.get_skeleton() if cache is not None else None
+
+
+## Parsed template skeleton ##
+# Opening the template unzips it and parses every XML part, which is most of the render
+# time of a small quote. Instead the template is parsed once per version, and each quote
+# starts from a deep copy of just the parts it changes: the main document and the
+# headers and footers that hold placeholders. Styles, numbering, images and the rest are
+# shared read-only between copies. The placeholder names, the paragraphs holding them
+# and the {{items}} anchor are located at load time, so rendering goes straight to them.
+class TemplateSkeleton:
+    def __init__(self, content):
+        self.content = content
+        self.version = template_version(content)
+        self.document = Document(io.BytesIO(content))
+        self.package = self.document.part.package
+        self.placeholder_paths = []
+        self.placeholders = set()
+        self.items_path = None
+
+        body = self.document.element.body
+        for paragraph in body.iterchildren(W_P):
+            if '{{items}}' in paragraph_text(paragraph):
+                self.items_path = element_path(self.document.element, paragraph)
+                break
+
+        mutable_parts = {self.document.part}
+        for part in template_story_parts(self.document.part):
+            for paragraph in part.element.iter(W_P):
+                names = {match.group(1) for match in PLACEHOLDER_PATTERN.finditer(paragraph_text(paragraph))}
+                if names - RESERVED_PLACEHOLDERS:
+                    self.placeholders |= names - RESERVED_PLACEHOLDERS
+                    self.placeholder_paths.append((part.partname, element_path(part.element, paragraph)))
+                    mutable_parts.add(part)
+
+        # Parts deepcopy should hand out as they are instead of copying
+        self._shared = {id(part): part for part in self.package.iter_parts() if part not in mutable_parts}
+
+    def new_document(self):
+        package = copy.deepcopy(self.package, dict(self._shared))
+        document = package.main_document_part.document
+        parts = {part.partname: part for part in template_story_parts(document.part)}
+        paragraphs = [resolve_path(parts[partname].element, path) for partname, path in self.placeholder_paths]
+        items_paragraph = resolve_path(document.element, self.items_path) if self.items_path else None
+        return document, paragraphs, items_paragraph
+
+def template_version(content):
+    # Identifies the template by its bytes, for the rendered output cache
+    return hashlib.sha256(content).hexdigest()
+
+def template_story_parts(document_part):
+    # The main document part followed by every header and footer part
+    yield document_part
+    for rel in document_part.rels.values():
+        if not rel.is_external and rel.reltype in (RT.HEADER, RT.FOOTER):
+            yield rel.target_part
+
+def element_path(root, element):
+    path = []
+    while element is not root:
+        parent = element.getparent()
+        path.append(parent.index(element))
+        element = parent
+    return tuple(reversed(path))
+
+def resolve_path(root, path):
+    element = root
+    for index in path:
+        element = element[index]
+    return element
     
-def get_access_token():
+def request_access_token():
     tenant_id = SP_TENANT_ID
     client_id = SP_CLIENT_ID
     client_secret = SP_CLIENT_SECRET
@@ -95,474 +810,1064 @@ def get_access_token():
         'scope': scope
     }
 
-    response = requests.post(url, data=payload)
+    response = graph_session.post(url, data=payload)
     response_data = response.json()
     if response.status_code == 200:
-        return response_data.get('access_token')
+        return response_data.get('access_token'), int(response_data.get('expires_in', 3599))
     else:
         print("Failed to retrieve access token:", response_data.get('error_description'))
-        return None
+        return None, 0
+
+## Graph access token cache ##
+# Client-credentials tokens are valid for about an hour. The token is reused until
+# TOKEN_EXPIRY_MARGIN seconds before it expires, and a timer fetches the next one
+# TOKEN_PROACTIVE_REFRESH seconds before that so requests never wait on the login call.
+# When the token is stale anyway only one thread refreshes it, the others wait for it.
+class GraphTokenProvider:
+    def __init__(self, expiry_margin, proactive_refresh):
+        self.expiry_margin = expiry_margin
+        self.proactive_refresh = proactive_refresh
+        self.token = None
+        self.expires_at = 0.0
+        self._refresh_lock = threading.Lock()
+        self._timer = None
+
+    def is_valid(self):
+        return self.token is not None and time.monotonic() < self.expires_at - self.expiry_margin
+
+    def get(self):
+        if self.is_valid():
+            return self.token
+        with self._refresh_lock:
+            # Whoever held the lock before us may already have refreshed the token
+            if not self.is_valid():
+                self._refresh()
+            return self.token if self.is_valid() else None
+
+    def _refresh(self):
+        token, expires_in = request_access_token()
+        if not token:
+            return
+        self.token = token
+        self.expires_at = time.monotonic() + expires_in
+        self._schedule_refresh(expires_in)
+
+    def _schedule_refresh(self, expires_in):
+        if self._timer is not None:
+            self._timer.cancel()
+        delay = max(expires_in - self.expiry_margin - self.proactive_refresh, 0)
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        with self._refresh_lock:
+            expires_at = self.expires_at
+            try:
+                self._refresh()
+            except Exception as e:
+                print(f"Error refreshing access token: {e}")
+            if self.expires_at == expires_at and self.is_valid():
+                # Refresh failed but the current token is still usable, try again shortly
+                self._timer = threading.Timer(30, self._background_refresh)
+                self._timer.daemon = True
+                self._timer.start()
+
+
+token_provider = GraphTokenProvider(TOKEN_EXPIRY_MARGIN, TOKEN_PROACTIVE_REFRESH)
+
+def get_access_token():
+    return token_provider.get()
 
     
-def upload_to_sharepoint(file_stream, filename, folder_name, access_token):
+def upload_to_sharepoint(content, filename, folder_name, access_token=None):
+    if access_token is None:
+        access_token = get_access_token()
     site_id = '2eb916ed-b02a-40b4-965f-38831bea5688'  # Ensure this is your correct SharePoint site ID
-    upload_url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drive/root:/{folder_name}/{filename}:/content"
+    item_url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drive/root:/{folder_name}/{filename}:"
+    if len(content) > SHAREPOINT_SIMPLE_UPLOAD_LIMIT:
+        # Graph refuses simple uploads over 4 MB
+        return upload_in_chunks(content, item_url, access_token)
+
+    upload_url = f"{item_url}/content"
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/octet-stream'
     }
-    file_stream.seek(0)  # Ensure the stream is at the beginning
-    response = requests.put(upload_url, headers=headers, data=file_stream)
-    if response.status_code == 201:
+    # The rendered bytes are sent as they are, without another copy into a stream
+    response = graph_session.put(upload_url, headers=headers, data=content)
+    if response.status_code in [200, 201]:
         print("File uploaded successfully to SharePoint.")
         return "Upload successful"
     else:
         print(f"Failed to upload file to SharePoint: {response.status_code} {response.text}")
         return "Upload failed"
-    
+
+## Chunked SharePoint uploads ##
+# Large documents go through a Graph upload session. The file is sent in
+# SHAREPOINT_CHUNK_SIZE pieces cut from a memoryview of the rendered bytes, so only one
+# chunk is copied at a time. Throttling and server errors are already retried by the
+# request scheduler, so here a chunk is only retried when it timed out or the session
+# disagrees about the range. Before retrying, the session is asked which bytes it still
+# expects, so nothing that already arrived is sent again. An expired session is replaced
+# and the upload starts over. No retry waits past the job deadline.
+def create_upload_session(item_url, access_token):
+    url = f"{item_url}/createUploadSession"
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }
+    payload = {"item": {"@microsoft.graph.conflictBehavior": "replace"}}
+    response = graph_session.post(url, headers=headers, json=payload)
+    if response.ok:
+        return response.json()['uploadUrl']
+    print(f"Failed to create upload session: {response.status_code} {response.text}")
+    return None
+
+def cancel_upload_session(upload_url):
+    try:
+        graph_session.delete(upload_url)
+    except requests.RequestException as e:
+        print(f"Failed to cancel SharePoint upload session: {e}")
+
+def next_expected_offset(session_status, default):
+    # nextExpectedRanges looks like ["26214400-"] or ["0-1048575", "2097152-"]
+    ranges = session_status.get('nextExpectedRanges') or []
+    return int(ranges[0].split('-')[0]) if ranges else default
+
+def upload_in_chunks(content, item_url, access_token):
+    view = memoryview(content)
+    total = len(view)
+    upload_url = create_upload_session(item_url, access_token)
+    if upload_url is None:
+        return "Upload failed"
+
+    start = 0
+    failures = 0
+    while True:
+        end = min(start + SHAREPOINT_CHUNK_SIZE, total)
+        # The upload URL carries its own authorization, the bearer token must not be sent
+        headers = {
+            'Content-Length': str(end - start),
+            'Content-Range': f'bytes {start}-{end - 1}/{total}'
+        }
+        response = None
+        try:
+            response = graph_session.put(upload_url, headers=headers, data=view[start:end].tobytes(),
+                                         timeout=SHAREPOINT_CHUNK_TIMEOUT)
+        except requests.exceptions.ReadTimeout as e:
+            # The chunk may still have arrived, the session is asked below
+            print(f"Timed out uploading bytes {start}-{end - 1} of {total} to SharePoint: {e}")
+        except requests.RequestException as e:
+            print(f"Error uploading bytes {start}-{end - 1} of {total} to SharePoint: {e}")
+            cancel_upload_session(upload_url)
+            return "Upload failed"
+
+        if response is not None and response.status_code in [200, 201]:
+            print("File uploaded successfully to SharePoint.")
+            return "Upload successful"
+        if response is not None and response.status_code == 202:
+            start = next_expected_offset(response.json(), end)
+            failures = 0
+            continue
+
+        failures += 1
+        # 404: the session expired, 409/416: it expects a different range
+        retryable = response is None or response.status_code in [404, 409, 416]
+        delay = min(2 ** failures, 30) if response is None else 0
+        remaining = time_left()
+        if not retryable or failures > SHAREPOINT_CHUNK_RETRIES or (remaining is not None and delay >= remaining):
+            if response is not None:
+                print(f"Failed to upload file to SharePoint: {response.status_code} {response.text}")
+            cancel_upload_session(upload_url)
+            return "Upload failed"
+        if delay:
+            time.sleep(delay)
+
+        # Ask the session where to carry on, the chunk may have arrived without its response
+        try:
+            status = graph_session.get(upload_url, timeout=SHAREPOINT_CHUNK_TIMEOUT)
+        except requests.RequestException:
+            continue
+        if status.status_code == 404:
+            print("SharePoint upload session expired, starting a new one.")
+            upload_url = create_upload_session(item_url, access_token)
+            if upload_url is None:
+                return "Upload failed"
+            start = 0
+        elif status.ok:
+            start = next_expected_offset(status.json(), start)
+
+## Line items ##
+# Amounts are kept as Decimal from the moment they are read from the payload and are
+# only formatted as "$1,234.00" when the table is rendered. Items come either as
+# numbered fields (item1, qty1, price1, Unit_1, itemDescrip1, itemMAX_1, ... with no
+# upper limit) or as an "items" list of objects with item, description, qty, unit,
+# price and max keys.
+CENTS = Decimal('0.01')
+MAX_DIGITS = 15  # digits before the decimal point a quantity or price may have
+ITEM_KEY_PATTERN = re.compile(r'^item(\d+)$')
+
+class LineItem:
+    __slots__ = ('item_number', 'description', 'qty', 'unit', 'unit_price', 'total', 'max_per_box')
+
+    def __init__(self, item_number, description, qty, unit, unit_price, max_per_box=None):
+        self.item_number = item_number
+        self.description = description
+        self.qty = qty
+        self.unit = unit
+        self.unit_price = unit_price
+        self.total = (qty * unit_price).quantize(CENTS, rounding=ROUND_HALF_UP)
+        self.max_per_box = max_per_box if max_per_box and max_per_box > 0 else Decimal(1)
+
+def parse_decimal(value, field, default='0'):
+    if value is None:
+        value = default
+    text = str(value).strip().replace('$', '').replace(',', '')
+    if not text:
+        text = default
+    try:
+        number = Decimal(text)
+    except InvalidOperation:
+        raise JobError(f"Invalid number {value!r} in field '{field}'")
+    # NaN and Infinity parse, and so does 1e400, which cannot be rounded to cents
+    if not number.is_finite() or number.adjusted() >= MAX_DIGITS:
+        raise JobError(f"Invalid number {value!r} in field '{field}'")
+    return number
+
+def format_money(amount):
+    return f"${Decimal(amount).quantize(CENTS, rounding=ROUND_HALF_UP):,.2f}"
+
 def extract_items(data):
+    if isinstance(data.get('items'), list):
+        return [item_from_entry(entry, index) for index, entry in enumerate(data['items'], start=1)
+                if isinstance(entry, dict) and entry.get('item')]
+
+    numbers = sorted(int(match.group(1)) for match in map(ITEM_KEY_PATTERN.match, data) if match)
     items = []
-    for i in range(1, 6):  # Assuming there are 5 items at most
+    for i in numbers:
         item_key = f'item{i}'
-        if item_key in data and data[item_key]:
-            item_number = data.get(item_key)
-            description_key = f'itemDescrip{i}'
-            description = data.get(description_key, '')
-            qty_str = data.get(f'qty{i}', '0').strip()
-            qty = float(qty_str) if qty_str else 0
-            unit_key = f'Unit_{i}'
-            unit = data.get(unit_key, 'EA')
-            price_str = data.get(f'price{i}', '0.0').strip()
-            price = float(price_str) if price_str else 0.0
-            total = qty * price
-            items.append({
-                "Item#": item_number,
-                "Description": description,
-                "Qty": qty,
-                "Unit": unit,
-                "Unit Price": f"${price:,.2f}",
-                "Total": f"${total:,.2f}"
-            })
+        if data[item_key]:
+            items.append(LineItem(
+                item_number=data[item_key],
+                description=data.get(f'itemDescrip{i}', ''),
+                qty=parse_decimal(data.get(f'qty{i}'), f'qty{i}'),
+                unit=data.get(f'Unit_{i}', 'EA'),
+                unit_price=parse_decimal(data.get(f'price{i}'), f'price{i}'),
+                max_per_box=parse_decimal(data.get(f'itemMAX_{i}'), f'itemMAX_{i}', default='1')
+            ))
     return items
 
-def create_word_document(data, items, template_content, access_token):
+def item_from_entry(entry, index):
+    return LineItem(
+        item_number=entry['item'],
+        description=entry.get('description', ''),
+        qty=parse_decimal(entry.get('qty'), f'items[{index}].qty'),
+        unit=entry.get('unit', 'EA'),
+        unit_price=parse_decimal(entry.get('price'), f'items[{index}].price'),
+        max_per_box=parse_decimal(entry.get('max'), f'items[{index}].max', default='1')
+    )
+
+## Concurrent network calls ##
+# Uploads, attachments and the Jira follow-up calls do not depend on each other (apart
+# from the comment that links the attachments), so they share a bounded pool instead of
+# running one after the other. Only the job thread submits work here, tasks never wait
+# on other tasks, so the pool cannot deadlock on itself. Tasks keep the deadline of the
+# job that submitted them.
+io_executor = DeadlineExecutor(max_workers=IO_WORKERS, thread_name_prefix='quote-io')
+
+def run_stage(job, name, func, *args):
+    # Run one checkpointed step of a job, or return its recorded result if it already ran.
+    # A step that fails must raise, otherwise its failure is checkpointed as the result
+    # and a replay would hand it back instead of trying again.
+    if job.is_done(name):
+        return job.outputs.get(name)
+    with job.stage(name):
+        result = func(*args)
+        job.set_output(name, result)
+    return result
+
+def wait_for_all(futures):
+    # Wait for every future and only then raise the first error, so no call is left running unnoticed
+    errors = []
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+
+def upload_document(content, filename, document, access_token):
+    # Raises instead of returning the failure, so the stage is not checkpointed as done
+    result = upload_to_sharepoint(content, filename, 'Quotes', access_token)
+    if result != "Upload successful":
+        raise JobError(f"Failed to upload {document} document to SharePoint")
+    return result
+
+def quote_filename(data):
+    client_name = data.get('clientName', 'Unknown_Client')
+    issue_key = data.get('key', 'Unknown_Key')
+    return f"{client_name}_{issue_key}"
+
+def render_quote_document(template, data, items, today_date):
+    # Start from a fresh copy of the parsed template
+    document, placeholder_paragraphs, items_paragraph = template.new_document()
+    table, total_sum = build_items_table(document, items)
+    replace_placeholders(document, data, today_date, placeholder_paragraphs, template.placeholders)
+
+    # Replace the {{items}} placeholder and insert the table
+    if items_paragraph is not None:
+        Paragraph(items_paragraph, document).clear()
+        items_paragraph.addnext(table)  # Insert the table XML element after the paragraph XML element
+    else:
+        print("Warning: '{{items}}' placeholder not found in the document. Table appended at the end of the document.")
+        document.add_page_break()
+        new_paragraph = document.add_paragraph()
+        new_paragraph._p.addnext(table)
+
+    # Save the document into memory, every uploader reads from these bytes
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue(), total_sum
+
+## Render worker processes ##
+# Rendering is pure Python XML work and holds the GIL, so with RENDER_WORKERS set it
+# runs in a pool of worker processes instead of on the threads serving requests. Each
+# worker parses a template version once and keeps the most recently used
+# TEMPLATE_CACHE_SIZE of them. Renders only name the template version, and its bytes are
+# sent again only to a worker that has not loaded it yet. A render still running after
+# RENDER_TIMEOUT seconds has its pool torn down, since a single worker process cannot be
+# stopped on its own.
+class RenderPool:
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool_for(self, template):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.size, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=load_worker_templates, initargs=({template.version: template.content},))
+            return self._executor
+
+    def _discard(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        processes = list((executor._processes or {}).values())
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+    def render(self, template, data, today_date):
+        content = None
+        crashed = False
+        while True:
+            executor = self._pool_for(template)
+            future = executor.submit(render_in_worker, template.version, content, data, today_date)
+            try:
+                word_content, total_sum = future.result(timeout=self.timeout)
+                return word_content, Decimal(total_sum)
+            except TemplateNotLoaded:
+                content = template.content
+            except FutureTimeoutError:
+                if future.cancel():
+                    raise JobError(f"No render worker became free within {self.timeout}s")
+                self._discard(executor)
+                raise JobError(f"Rendering timed out after {self.timeout}s")
+            except BrokenProcessPool:
+                # A worker died, or the pool was torn down for another render that hung
+                self._discard(executor)
+                if crashed:
+                    raise JobError("Render worker crashed")
+                crashed = True
+
+    def start(self, template):
+        # Spawns every worker and waits for it to parse the template, instead of
+        # leaving that to the first quotes
+        executor = self._pool_for(template)
+        futures = [executor.submit(render_worker_ready) for _ in range(self.size)]
+        for future in futures:
+            future.result(timeout=self.timeout)
+
+render_pool = RenderPool(RENDER_WORKERS, RENDER_TIMEOUT) if RENDER_WORKERS else None
+
+worker_templates = OrderedDict()  # template version -> TemplateSkeleton, in each worker process
+
+class TemplateNotLoaded(Exception):
+    pass
+
+def load_worker_templates(templates):
+    for version, content in templates.items():
+        worker_template(version, content)
+
+def worker_template(version, content=None):
+    template = worker_templates.get(version)
+    if template is not None:
+        worker_templates.move_to_end(version)
+        return template
+    if content is None:
+        raise TemplateNotLoaded(version)
+    template = worker_templates[version] = TemplateSkeleton(content)
+    while len(worker_templates) > TEMPLATE_CACHE_SIZE:
+        worker_templates.popitem(last=False)
+    return template
+
+def render_worker_ready():
+    return os.getpid()
+
+def render_in_worker(version, content, data, today_date):
+    template = worker_template(version, content)
+    word_content, total_sum = render_quote_document(template, data, extract_items(data), today_date)
+    return word_content, str(total_sum)
+
+def render_quote(template, data, items, today_date):
+    if render_pool is None:
+        return render_quote_document(template, data, items, today_date)
+    return render_pool.render(template, data, today_date)
+
+def output_options():
+    # Part of the output cache key, so documents cached under other settings are not reused
+    if not OPTIMIZE_OUTPUTS:
+        return None
+    return {'max_image_pixels': OPTIMIZE_MAX_IMAGE_PIXELS, 'jpeg_quality': OPTIMIZE_JPEG_QUALITY}
+
+def optimize_output(job, document, content):
+    if document == 'docx':
+        optimized = optimize_docx(content, OPTIMIZE_MAX_IMAGE_PIXELS, OPTIMIZE_JPEG_QUALITY)
+    else:
+        optimized = optimize_pdf(content)
+    record_bytes_saved(job, document, len(content), len(optimized))
+    return optimized
+
+def record_bytes_saved(job, document, size_before, size_after):
+    metrics.output_bytes_saved.inc(size_before - size_after, document=document)
+    job.set_output(f'{document}_bytes_saved', size_before - size_after)
+    print(f"Optimized {document} for {job.issue_key}: {size_before} -> {size_after} bytes.")
+
+def create_word_document(data, items, template, access_token, job=None):
+    job = job or QuoteJob(data)
     try:
         today_date = datetime.now().strftime("%Y-%m-%d")
-        client_name = data.get('clientName', 'Unknown_Client')
         issue_key = data.get('key', 'Unknown_Key')
-        filename = f"{client_name}_{issue_key}"
-
-        # Load the template document from bytes
-        document = Document(template_content)
-        table = document.add_table(rows=1, cols=6)
-        table.style = 'Table Grid'
-        populate_table_header(table.rows[0])
-        total_sum = populate_table_data(table, items)
-        phi_collect(table, items)
-        phi_shipping(table, items, data)
-        add_final_row(table, total_sum)
-        replace_placeholders(document, data, today_date)
-
-        # Replace the {{items}} placeholder and insert the table
-        found_placeholder = False
-        for paragraph in document.paragraphs:
-            if '{{items}}' in paragraph.text:
-                paragraph.text = ''
-                p = paragraph._p  # Get the XML element for the paragraph
-                p.addnext(table._tbl)  # Insert the table XML element after the paragraph XML element
-                found_placeholder = True
-                break
-        if not found_placeholder:
-            print("Warning: '{{items}}' placeholder not found in the document. Table appended at the end of the document.")
-            document.add_page_break()
-            new_paragraph = document.add_paragraph()
-            new_paragraph._p.addnext(table._tbl)
+        filename = quote_filename(data)
 
-        # Save the document to a Word file
         word_filename = f"{filename}.docx"
-        document.save(word_filename)
+        pdf_filename = f"{filename}.pdf"
+
+        cache_key = None
+        pdf_content = None
+        if job.is_done('render'):
+            # Resuming an interrupted job, the document was rendered before the restart
+            total_sum = Decimal(str(job.outputs['total_sum']))
+            word_content = job.load_artifact('docx')
+        else:
+            with job.stage('render'):
+                cache_key = output_key(job.payload_hash, template.version, today_date, output_options())
+                cached = output_cache.get(cache_key) if output_cache is not None else None
+                if cached is not None:
+                    # The same payload was rendered from the same template today, reuse both documents
+                    word_content, pdf_content, meta = cached
+                    total_sum = Decimal(meta['total_sum'])
+                    job.set_output('output_cache', 'hit')
+                else:
+                    word_content, total_sum = render_quote(template, data, items, today_date)
+                job.save_artifact('docx', word_content)
+                job.set_output('total_sum', str(total_sum))
+
+        # Documents from the output cache were optimized before they were stored
+        from_cache = job.outputs.get('output_cache') == 'hit'
+        optimize = OPTIMIZE_OUTPUTS and not from_cache
+
+        # Shrink the Word document before the conversion, so the PDF gets the smaller images too
+        if optimize and not job.is_done('optimize_docx') and not job.is_done('convert'):
+            with job.stage('optimize_docx'):
+                word_content = optimize_output(job, 'docx', word_content)
+                job.save_artifact('docx', word_content)
 
         # Convert the Word document to PDF
-        pdf_filename = f"{filename}.pdf"
-        convert_to_pdf(word_filename, pdf_filename)
-
-        # Upload both Word and PDF documents to SharePoint
-        with open(word_filename, 'rb') as word_file, open(pdf_filename, 'rb') as pdf_file:
-            word_stream = io.BytesIO(word_file.read())
-            pdf_stream = io.BytesIO(pdf_file.read())
-            upload_result_word = upload_to_sharepoint(word_stream, word_filename, 'Quotes', access_token)
-            upload_result_pdf = upload_to_sharepoint(pdf_stream, pdf_filename, 'Quotes', access_token)
-            
-            # Attach the PDF AND Word Doc to the JIRA issue
-            if upload_result_pdf == "Upload successful":
-                attach_pdf_to_jira_issue(issue_key, pdf_filename)
-            if upload_result_word == "Upload successful":
-                attach_word_doc_jira(issue_key, word_filename)
-
-        # Cleanup: delete temporary files
-        os.remove(word_filename)
-        os.remove(pdf_filename)
-    
-        # Check if the total sum is greater than $4000 and then call approved_quote if needed
-        if total_sum > 4000:
-            print(f"Total sum is {total_sum}, which is greater than $4000. Running approved_quote.")
-            approved_quote(issue_key)
+        if job.is_done('convert'):
+            pdf_content = job.load_artifact('pdf')
         else:
-            print(f"Total sum is {total_sum}, which is not greater than $4000. Skipping approved_quote.")
-            needs_review(issue_key, total_sum, connect_to_jira())
+            with job.stage('convert'):
+                if pdf_content is None:
+                    pdf_content = convert_bytes_to_pdf(word_content)
+                    if pdf_content is None:
+                        raise JobError("Failed to convert DOCX to PDF")
+                job.save_artifact('pdf', pdf_content)
+
+        if optimize and not job.is_done('optimize_pdf'):
+            with job.stage('optimize_pdf'):
+                pdf_content = optimize_output(job, 'pdf', pdf_content)
+                job.save_artifact('pdf', pdf_content)
+
+        if cache_key is not None and output_cache is not None and not from_cache:
+            output_cache.put(cache_key, word_content, pdf_content, {'total_sum': str(total_sum)})
+
+        # Upload both documents to SharePoint and attach them to the JIRA issue side by side
+        uploads = {
+            'upload_sharepoint_word': io_executor.submit(
+                run_stage, job, 'upload_sharepoint_word', upload_document, word_content, word_filename, 'word', access_token),
+            'upload_sharepoint_pdf': io_executor.submit(
+                run_stage, job, 'upload_sharepoint_pdf', upload_document, pdf_content, pdf_filename, 'pdf', access_token),
+            'attach_jira': io_executor.submit(
+                run_stage, job, 'attach_jira', attach_documents_to_jira, issue_key, [
+                    (pdf_filename, pdf_content, PDF_CONTENT_TYPE),
+                    (word_filename, word_content, DOCX_CONTENT_TYPE)
+                ])
+        }
+
+        # Check if the total sum is greater than $4000 and then call approved_quote if needed.
+        # The approval comment links the new attachments, so it waits for them. The review
+        # comment and assignment do not and run while the uploads are still going.
+        try:
+            if total_sum > 4000:
+                print(f"Total sum is {total_sum}, which is greater than $4000. Running approved_quote.")
+                attachments = uploads['attach_jira'].result()
+                run_stage(job, 'post_process', approved_quote, issue_key, attachments, workflow_key(data), job)
+            else:
+                print(f"Total sum is {total_sum}, which is not greater than $4000. Skipping approved_quote.")
+                run_stage(job, 'post_process', needs_review, issue_key, total_sum, job)
+        finally:
+            wait_for_all(uploads.values())
 
         return "Upload successful"
+    except JobError as e:
+        # The reason is kept on the job, so /jobs/<id> and replay_jobs.py show it
+        print(f"Error in create_word_document: {e}")
+        return str(e)
     except Exception as e:
         print(f"Error in create_word_document: {e}")
         return "Error creating document"
 
-def populate_table_header(row):
-    headers = ["Item#", "Description", "Qty", "Unit", "Unit Price", "Total"]
-    for idx, header in enumerate(headers):
-        cell = row.cells[idx]
-        cell.text = header
-        set_cell_background(cell, "2887dd")  # Set blue background
-        paragraph = cell.paragraphs[0]
-        paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        run = paragraph.runs[0]
-        run.font.bold = True
-        run.font.color.rgb = RGBColor(255, 255, 255)
-        run.font.size = Pt(12)
-        cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
-        cell.width = Cm(4) if header != "Description" else Cm(10)
-
-def populate_table_data(table, items):
-    total_sum = 0
+## Line-item table ##
+# The table is written as WordprocessingML text from the row templates below and parsed
+# once, instead of being built cell by cell through python-docx, which adds a dozen XML
+# elements per cell. The output matches what python-docx produced: a "Table Grid" table
+# with a blue bold header, centred cells and a borderless total row.
+TABLE_HEADERS = ["Item#", "Description", "Qty", "Unit", "Unit Price", "Total"]
+
+TABLE_TEMPLATE = (
+    '<w:tbl %s>'
+    '<w:tblPr><w:tblStyle w:val="{style_id}"/><w:tblW w:type="auto" w:w="0"/>'
+    '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0" w:noHBand="0" w:noVBand="1" w:val="04A0"/>'
+    '</w:tblPr>'
+    '<w:tblGrid>{grid}</w:tblGrid>'
+    '{rows}'
+    '</w:tbl>'
+) % nsdecls('w')
+
+GRID_COLUMN_TEMPLATE = '<w:gridCol w:w="{width}"/>'
+
+HEADER_CELL_TEMPLATE = (
+    '<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width}"/><w:shd w:val="clear" w:color="auto" w:fill="2887dd"/>'
+    '<w:vAlign w:val="center"/></w:tcPr>'
+    '<w:p><w:pPr><w:jc w:val="center"/></w:pPr>'
+    '<w:r><w:rPr><w:b/><w:color w:val="FFFFFF"/><w:sz w:val="24"/></w:rPr><w:t xml:space="preserve">{text}</w:t></w:r></w:p>'
+    '</w:tc>'
+)
+
+ITEM_CELL_TEMPLATE = (
+    '<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width}"/><w:vAlign w:val="center"/></w:tcPr>'
+    '<w:p><w:pPr><w:jc w:val="center"/></w:pPr>{run}</w:p>'
+    '</w:tc>'
+)
+
+EXTRA_CELL_TEMPLATE = (
+    '<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width}"/></w:tcPr>'
+    '<w:p><w:pPr><w:jc w:val="center"/></w:pPr>{run}</w:p>'
+    '</w:tc>'
+)
+
+# Attempting to Remove Inside Borders from the last row for the ALL_Total
+TOTAL_CELL_TEMPLATE = (
+    '<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width}"/>'
+    '<w:tcBorders><w:top w:val="nil"/><w:left w:val="nil"/><w:bottom w:val="nil"/><w:right w:val="nil"/></w:tcBorders>'
+    '</w:tcPr>'
+    '<w:p><w:pPr><w:jc w:val="center"/></w:pPr>{run}</w:p>'
+    '</w:tc>'
+)
+
+RUN_TEMPLATE = '<w:r><w:t xml:space="preserve">{text}</w:t></w:r>'
+
+def header_widths():
+    return [Cm(10).twips if header == "Description" else Cm(4).twips for header in TABLE_HEADERS]
+
+def table_row(cell_template, values, widths):
+    cells = []
+    for value, width in zip(values, widths):
+        run = RUN_TEMPLATE.format(text=escape(str(value))) if value != "" else ""
+        cells.append(cell_template.format(width=width, run=run))
+    return '<w:tr>' + ''.join(cells) + '</w:tr>'
+
+def build_items_table(document, items):
+    # Returns the finished w:tbl element and the sum of the line item totals
+    style_id = document.part.get_style_id('Table Grid', WD_STYLE_TYPE.TABLE)
+    column_width = int(document._block_width.twips / len(TABLE_HEADERS))
+    column_widths = [column_width] * len(TABLE_HEADERS)
+
+    rows = ['<w:tr>' + ''.join(
+        HEADER_CELL_TEMPLATE.format(width=width, text=escape(header))
+        for header, width in zip(TABLE_HEADERS, header_widths())) + '</w:tr>']
+
+    item_rows, total_sum = populate_table_data(items)
+    rows.extend(table_row(ITEM_CELL_TEMPLATE, values, column_widths) for values in item_rows)
+    for extra_row in (phi_collect(items), phi_shipping(items)):
+        if extra_row:
+            rows.append(table_row(EXTRA_CELL_TEMPLATE, extra_row, column_widths))
+    rows.append(table_row(TOTAL_CELL_TEMPLATE, add_final_row(total_sum), column_widths))
+
+    grid = ''.join(GRID_COLUMN_TEMPLATE.format(width=width) for width in column_widths)
+    table = parse_xml(TABLE_TEMPLATE.format(style_id=style_id, grid=grid, rows=''.join(rows)))
+    return table, total_sum
+
+def populate_table_data(items):
+    rows = []
+    total_sum = Decimal(0)
     for item in items:
-        row = table.add_row().cells
-        for idx, key in enumerate(["Item#", "Description", "Qty", "Unit", "Unit Price", "Total"]):
-            if key == "Qty":  # Check if the current cell is for the Qty column
-                row[idx].text = str(int(item[key]))  # Convert quantity to integer before displaying
-            else:
-                row[idx].text = str(item[key])
-            paragraph = row[idx].paragraphs[0]
-            paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            row[idx].vertical_alignment = WD_ALIGN_VERTICAL.CENTER
-            if key == "Total":
-                total_sum += float(item[key].strip('$').replace(',', ''))
-    return total_sum
-
-def add_final_row(table, total_sum):
-    row = table.add_row().cells
-    row[4].text = "Total"
-    row[5].text = f"${total_sum:,.2f}"
-
-    for cell in row:
-        paragraph = cell.paragraphs[0]
-        paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        remove_borders(cell)
-
-def set_cell_background(cell, fill):
-    shading = OxmlElement('w:shd')
-    shading.set(qn('w:fill'), fill)
-    cell._element.get_or_add_tcPr().append(shading)
-
-#Attempting to Remove Inside Borders from the last row for the ALL_Total
-def remove_borders(cell):
-    for border in ["top", "left", "bottom", "right"]:
-        tag = 'w:' + border + 'Border'
-        element = OxmlElement(tag)
-        element.set(qn('w:val'), 'nil')
-        cell._element.get_or_add_tcPr().append(element)
-        
+        rows.append([
+            item.item_number,
+            item.description,
+            str(int(item.qty)),  # Convert quantity to integer before displaying
+            item.unit,
+            format_money(item.unit_price),
+            format_money(item.total)
+        ])
+        total_sum += item.total
+    return rows, total_sum
+
+def add_final_row(total_sum):
+    return ["", "", "", "", "Total", format_money(total_sum)]
+
 # IF PhiCollect equals "YES"
 
-def phi_collect(table, items):
+def phi_collect(items):
     phi_collect_value = "yes"  
     if phi_collect_value.lower() == "yes":
-        row = table.add_row().cells
-        for i in range(6):
-            row[i].text = ""
-        row[0].text = "WMS-800"
-        row[1].text = "Water Sample Collection"
-        qty_sum = sum(item["Qty"] for item in items)
+        qty_sum = sum((item.qty for item in items), Decimal(0))
         if qty_sum < 20:
-            row[2].text = "1"
-        else:
-            row[2].text = str(int(qty_sum))
-        row[3].text = "EA"
-        if row[2].text == "1":
-            row[4].text = "$600.00"
+            qty = 1
+            unit_price = Decimal('600.00')
         else:
-            row[4].text = "$30.00"
-        total_price = float(row[4].text.strip('$')) * int(row[2].text)
-        row[5].text = f"${total_price:,.2f}"
-        for cell in row:
-            paragraph = cell.paragraphs[0]
-            paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
+            qty = int(qty_sum)
+            unit_price = Decimal('30.00')
+        return ["WMS-800", "Water Sample Collection", str(qty), "EA", format_money(unit_price), format_money(unit_price * qty)]
+    return None
             
 #IF PhiShipping equals "YES"
 
-def phi_shipping(table, items, data):
+def phi_shipping(items):
     phi_shipping_value = "yes"  # Or from some configuration or data field
     if phi_shipping_value.lower() == "yes":
-        row = table.add_row().cells
-        for i in range(6):
-            row[i].text = ""
-        row[0].text = "WMS-9970"
-        row[1].text = "Shipping and Handling - Overnight Return"
-        total_divided_qty = sum(float(item['Qty']) / float(data.get(f'itemMAX_{i+1}', 1)) for i, item in enumerate(items))
+        total_divided_qty = sum((item.qty / item.max_per_box for item in items), Decimal(0))
         total_divided_qty_rounded = math.ceil(total_divided_qty)  # Use math.ceil to round up
-        row[2].text = str(total_divided_qty_rounded)
-        row[3].text = "BOX"
-        row[4].text = "$110.00"
-        total_price = 110.00 * total_divided_qty_rounded
-        row[5].text = f"${total_price:,.2f}"
-        for cell in row:
-            paragraph = cell.paragraphs[0]
-            paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
-
-def replace_placeholders(document, data, today_date):
-    for paragraph in document.paragraphs:
-        if '{{clientName}}' in paragraph.text:
-            paragraph.text = paragraph.text.replace('{{clientName}}', data.get('clientName', 'Unknown Client'))
-        if '{{pocName}}' in paragraph.text:
-            paragraph.text = paragraph.text.replace('{{pocName}}', data.get('pocName', ''))
-        if '{{title}}' in paragraph.text:
-            paragraph.text = paragraph.text.replace('{{title}}', data.get('title', ''))
-        if '{{clientCode}}' in paragraph.text:
-            paragraph.text = paragraph.text.replace('{{clientCode}}', data.get('clientCode', ''))
-        if '{{today_date}}' in paragraph.text:
-            paragraph.text = paragraph.text.replace('{{today_date}}', today_date)
-        if '{{issue_Key}}' in paragraph.text:
-            paragraph.text = paragraph.text.replace('{{issue_Key}}', data.get('key', ''))
-
-    for table in document.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                cell_text = cell.text
-                if '{{clientName}}' in cell_text:
-                    cell.text = cell_text.replace('{{clientName}}', data.get('clientName', 'Unknown Client'))
-                if '{{pocName}}' in cell_text:
-                    cell.text = cell_text.replace('{{pocName}}', data.get('pocName', ''))
-                if '{{title}}' in cell_text:
-                    cell.text = cell_text.replace('{{title}}', data.get('title', ''))
-                if '{{clientCode}}' in cell_text:
-                    cell.text = cell_text.replace('{{clientCode}}', data.get('clientCode', ''))
-                if '{{today_date}}' in cell_text:
-                    cell.text = cell_text.replace('{{today_date}}', today_date)
-                if '{{shippingAddress}}' in cell_text:
-                    cell.text = cell_text.replace('{{shippingAddress}}', data.get('shippingAddress', ''))
-                if '{{address}}' in cell_text:
-                    cell.text = cell_text.replace('{{address}}', data.get('address', ''))
-
-def replace_header(document, data):
-    for section in document.sections:
-        for header in section.header_parts:
-            for paragraph in header.paragraphs:
-                if '{{issue_Key}}' in paragraph.text:
-                    paragraph.text = paragraph.text.replace('{{issue_Key}}', data.get('key', ''))
+        unit_price = Decimal('110.00')
+        return ["WMS-9970", "Shipping and Handling - Overnight Return", str(total_divided_qty_rounded), "BOX",
+                format_money(unit_price), format_money(unit_price * total_divided_qty_rounded)]
+    return None
+
+## Placeholder substitution ##
+# Every {{field}} in the template is filled from the webhook payload, so new fields only
+# need adding to the automation, not here. The body (tables included), headers and
+# footers are walked once, or only the paragraphs the template skeleton found, and each
+# paragraph is only touched if it holds a known placeholder. Word often splits a
+# placeholder over several runs. The replacement is written into the run holding its
+# first character, which keeps that run's formatting, and the rest of the placeholder is
+# cut from the following runs.
+PLACEHOLDER_PATTERN = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+# Used when the payload does not carry the field at all
+PLACEHOLDER_DEFAULTS = {
+    'clientName': 'Unknown Client',
+    'pocName': '',
+    'title': '',
+    'clientCode': '',
+    'shippingAddress': '',
+    'address': ''
+}
+
+# Filled in by other steps of the render, so they are left in place here
+RESERVED_PLACEHOLDERS = {'items'}
+
+W_P = qn('w:p')
+W_T = qn('w:t')
+W_BR = qn('w:br')
+XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+
+def placeholder_values(data, today_date):
+    values = dict(PLACEHOLDER_DEFAULTS)
+    for key, value in data.items():
+        if isinstance(value, (str, int, float)) and key not in RESERVED_PLACEHOLDERS:
+            values[key] = str(value)
+    values['today_date'] = today_date
+    values['issue_Key'] = data.get('key', '')
+    return values
+
+def paragraph_text_nodes(paragraph):
+    # w:t nodes of this paragraph, not of paragraphs nested inside it (text boxes)
+    return [t for t in paragraph.iter(W_T) if next(t.iterancestors(W_P)) is paragraph]
+
+def paragraph_text(paragraph):
+    return ''.join(t.text or '' for t in paragraph_text_nodes(paragraph))
+
+def replace_in_paragraph(paragraph, values):
+    nodes = paragraph_text_nodes(paragraph)
+    texts = [t.text or '' for t in nodes]
+    text = ''.join(texts)
+    if '{{' not in text:
+        return False
+    matches = [m for m in PLACEHOLDER_PATTERN.finditer(text) if m.group(1) in values]
+    if not matches:
+        return False
+
+    offsets = []
+    position = 0
+    for node_text in texts:
+        offsets.append(position)
+        position += len(node_text)
+
+    # Work backwards so the offsets of earlier matches stay valid
+    for match in reversed(matches):
+        start, end = match.span()
+        first = next(i for i, offset in enumerate(offsets) if offset <= start < offset + len(texts[i]))
+        last = next(i for i, offset in enumerate(offsets) if offset < end <= offset + len(texts[i]))
+        first_text = nodes[first].text or ''
+        before = first_text[:start - offsets[first]]
+        if first == last:
+            after = first_text[end - offsets[first]:]
+        else:
+            after = ''
+            for i in range(first + 1, last):
+                nodes[i].text = ''
+            nodes[last].text = (nodes[last].text or '')[end - offsets[last]:]
+            nodes[last].set(XML_SPACE, 'preserve')
+        write_text(nodes[first], before, values[match.group(1)], after)
+    return True
+
+def write_text(node, before, value, after):
+    # Line breaks in the value (addresses) become w:br elements inside the same run
+    lines = value.split('\n')
+    node.text = before + lines[0] + (after if len(lines) == 1 else '')
+    node.set(XML_SPACE, 'preserve')
+    previous = node
+    for index, line in enumerate(lines[1:], start=1):
+        br = OxmlElement('w:br')
+        previous.addnext(br)
+        t = OxmlElement('w:t')
+        t.text = line + (after if index == len(lines) - 1 else '')
+        t.set(XML_SPACE, 'preserve')
+        br.addnext(t)
+        previous = t
+
+def replace_placeholders(document, data, today_date, paragraphs=None, names=None):
+    # paragraphs and names are the ones a TemplateSkeleton located already, without them
+    # every paragraph of the body, headers and footers is searched for every field
+    values = placeholder_values(data, today_date)
+    if names is not None:
+        values = {name: value for name, value in values.items() if name in names}
+    if paragraphs is None:
+        paragraphs = [paragraph for part in template_story_parts(document.part) for paragraph in part.element.iter(W_P)]
+    replaced = 0
+    for paragraph in paragraphs:
+        if replace_in_paragraph(paragraph, values):
+            replaced += 1
+    return replaced
                     
-## Function to connect to JIRA ##
-def connect_to_jira():
-    # Directly define credentials
-    username = 'user@email.com'
-    api_token = JIRA_API_TOKEN
-    
-    # Set up basic authentication
-    auth = HTTPBasicAuth(username, api_token)
-    return auth
 
 ## Function to add attachments to a JIRA issue ##
-def attach_pdf_to_jira_issue(issue_key, pdf_filename):
+PDF_CONTENT_TYPE = 'application/pdf'
+DOCX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+def attach_documents_to_jira(issue_key, documents):
+    # Every (filename, content, content type) goes in one multipart request. Jira answers
+    # with the new attachments, which are returned so the comment can link them directly.
     try:
         # Set up the URL for the JIRA REST API
         url = f"https://yoursite.atlassian.net/rest/api/3/issue/{issue_key}/attachments"
 
-        # Connect to JIRA
-        auth = connect_to_jira()
-
         # Set up the headers
         headers = {
             "X-Atlassian-Token": "no-check",
             "Accept": "application/json"
         }
 
-        # Open the PDF file in binary mode for uploading
-        with open(pdf_filename, 'rb') as pdf_file:
-            files = {
-                "file": (os.path.basename(pdf_filename), pdf_file, 'application/pdf')
-            }
+        files = [("file", document) for document in documents]
 
-            # Make the request to add the attachment
-            response = requests.post(url, headers=headers, files=files, auth=auth)
+        # Make the request to add the attachments
+        response = jira_session.post(url, headers=headers, files=files)
 
-            # Print the response from JIRA
-            if response.ok:
-                print("Attachment uploaded successfully!")
-                print(response.json())  # This will print the response JSON from JIRA
-            else:
-                print(f"Failed to upload attachment: {response.status_code} {response.text}")
+        if response.ok:
+            attachments = [{"id": attachment["id"], "filename": attachment["filename"]}
+                           for attachment in response.json()]
+            print(f"Attachments uploaded successfully: {', '.join(a['filename'] for a in attachments)}")
+            return attachments
+        else:
+            print(f"Failed to upload attachments: {response.status_code} {response.text}")
+            # Raised so the attach_jira stage is not checkpointed and a replay attaches again
+            raise JobError(f"Failed to attach documents to Jira: {response.status_code}")
 
     except Exception as e:
-        print(f"Error uploading attachment to JIRA: {e}")
+        print(f"Error uploading attachments to JIRA: {e}")
         raise
 
-def attach_word_doc_jira(issue_key, word_filename):
+## PDF conversion ##
+# The backend is chosen with PDF_CONVERTER: 'docx2pdf' drives Word on Windows,
+# 'libreoffice' keeps a pool of warm headless soffice processes and 'soffice' starts
+# one soffice process per document.
+pdf_converter = create_converter(PDF_CONVERTER, size=CONVERTER_WORKERS, timeout=CONVERTER_TIMEOUT,
+                                 max_jobs=CONVERTER_MAX_JOBS, soffice_path=SOFFICE_PATH)
+
+def convert_bytes_to_pdf(word_content):
     try:
-        # Set up the URL for the JIRA REST API
-        url = f"https://yoursite.atlassian.net/rest/api/3/issue/{issue_key}/attachments"
+        return pdf_converter.convert(word_content, timeout=CONVERTER_TIMEOUT)
+    except ConversionError as e:
+        print(f"Error converting DOCX to PDF: {e}")
+        return None
+
+## Rendered output cache ##
+# Set OUTPUT_CACHE_DIR to None to always render and convert
+output_cache = OutputCache(OUTPUT_CACHE_DIR, OUTPUT_CACHE_MAX_BYTES) if OUTPUT_CACHE_DIR else None
+    
+    
+## Jira lookup caches ##
+# Account ids and workflow transition ids hardly ever change, so they are looked up once
+# and kept for LOOKUP_CACHE_TTL seconds instead of costing a round trip on every quote.
+# An id that Jira rejects is dropped from the cache and looked up again. Failed lookups
+# are not cached.
+class LookupCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
 
-        # Connect to JIRA
-        auth = connect_to_jira()
+    def get(self, key, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                return entry[0]
+        value = loader()
+        if value is not None:
+            with self._lock:
+                self._entries[key] = (value, time.monotonic() + self.ttl)
+        return value
 
-        # Set up the headers
-        headers = {
-            "X-Atlassian-Token": "no-check",
-            "Accept": "application/json"
-        }
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
 
-        # Open the Word file in binary mode for uploading
-        with open(word_filename, 'rb') as word_file:
-            files = {
-                "file": (os.path.basename(word_filename), word_file, 'application/vnd.openxmlformats-officedocument.wordprocessingml.document')
-            }
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
 
-            # Make the request to add the attachment
-            response = requests.post(url, headers=headers, files=files, auth=auth)
+account_id_cache = LookupCache(LOOKUP_CACHE_TTL)
+transition_id_cache = LookupCache(LOOKUP_CACHE_TTL)
+refused_transition_cache = LookupCache(LOOKUP_CACHE_TTL)  # workflows whose Completed screen refuses the fields
 
-            # Print the response from JIRA
-            if response.ok:
-                print("Attachment uploaded successfully!")
-                print(response.json())  # This will print the response JSON from JIRA
-            else:
-                print(f"Failed to upload attachment: {response.status_code} {response.text}")
+def workflow_key(data):
+    # The transitions offered depend on the project's workflow for the issue type and on
+    # the issue's current status. Payloads without issueType/status share one
+    # entry per project.
+    issue_key = data.get('key', '')
+    return (issue_key.rsplit('-', 1)[0], data.get('issueType', ''), data.get('status', ''))
 
-    except Exception as e:
-        print(f"Error uploading attachment to JIRA: {e}")
-        raise
+def warm_lookup_caches():
+    get_account_id_by_email(REVIEW_ASSIGNEE_EMAIL)
 
-def convert_to_pdf(docx_path, pdf_path):
-    """
-    Convert a DOCX file to a PDF file using python-docx and convert docx.
-    """
-    try:
-        # Initialize the COM library for converting DOCX to PDF
-        pythoncom.CoInitialize()
 
-        # Convert DOCX to PDF
-        docx_to_pdf_convert(docx_path, pdf_path)
+## Jira follow-up plan ##
+# Everything a quote changes on its issue after the upload (the comment, the assignee,
+# the transition to Completed) is collected into one plan and sent in as few calls as
+# the workflow allows. A transition carries the comment and the assignee in the same
+# request, and without a transition the issue is edited once with both. If Jira refuses
+# the combined request, e.g. because a field is not on the transition or edit screen,
+# the parts are sent on their own, side by side. A workflow whose transition screen
+# refused the fields is remembered for LOOKUP_CACHE_TTL, and later quotes go straight to
+# the separate calls. Each separate call is checkpointed as its own stage of the job, so
+# a replay only sends the parts that failed and never posts the comment twice.
+PLAN_PARTS = ('post_process_comment', 'post_process_assign', 'post_process_transition')
+
+class JiraPlan:
+    def __init__(self, issue_key, comment=None, assignee_email=None, complete=False, workflow=None, job=None):
+        self.issue_key = issue_key
+        self.comment = comment
+        self.assignee_email = assignee_email
+        self.complete = complete
+        self.workflow = workflow
+        self.job = job
 
-        # Check if the PDF was created successfully
-        if os.path.exists(pdf_path):
-            # Uninitialize the COM library
-            pythoncom.CoUninitialize()
-            return True
+    def sent_separately(self):
+        # An earlier run already went to the separate calls, so the combined request could
+        # repeat a part that went through
+        return self.job is not None and any(part in self.job.stages for part in PLAN_PARTS)
+
+    def run_part(self, name, func, *args):
+        if self.job is None:
+            return func(*args)
+        return run_stage(self.job, name, func, *args)
+
+def run_jira_plan(plan):
+    if plan.sent_separately():
+        run_plan_separately(plan)
+        return
+    payload = {}
+    if plan.assignee_email:
+        account_id = get_account_id_by_email(plan.assignee_email)
+        if account_id:
+            payload["fields"] = {"assignee": {"accountId": account_id}}
+    if plan.comment:
+        payload["update"] = {"comment": [{"add": {"body": plan.comment}}]}
+
+    if len(payload) + plan.complete > 1:
+        refusal_key = (plan.workflow, tuple(sorted(payload)))
+        if plan.complete and refused_transition_cache.get(refusal_key, lambda: None):
+            # This workflow refused the same combined transition before, skip straight to separate calls
+            result = "Refused"
+        elif plan.complete:
+            result = transition_with_update(plan, payload)
+            if result == "Refused fields":
+                refused_transition_cache.put(refusal_key, True)
+                result = "Refused"
         else:
-            print("Failed to convert DOCX to PDF.")
-            # Uninitialize the COM library
-            pythoncom.CoUninitialize()
-            return False
-    except Exception as e:
-        print(f"Error converting DOCX to PDF: {e}")
-        # Uninitialize the COM library
-        pythoncom.CoUninitialize()
+            result = edit_issue(plan.issue_key, payload)
+        if result == "Failed":
+            # Nothing was applied, so the whole plan can be replayed
+            raise JobError(f"Failed to update {plan.issue_key} in Jira")
+        if result != "Refused":
+            return
+    run_plan_separately(plan)
+
+def run_plan_separately(plan):
+    calls = []
+    if plan.comment:
+        calls.append(io_executor.submit(plan.run_part, 'post_process_comment', post_adf_comment,
+                                        plan.issue_key, plan.comment))
+    if plan.assignee_email:
+        calls.append(io_executor.submit(plan.run_part, 'post_process_assign', assign_ticket,
+                                        plan.issue_key, plan.assignee_email))
+    if plan.complete:
+        calls.append(io_executor.submit(plan.run_part, 'post_process_transition', transition_issue_to_completed,
+                                        plan.issue_key, plan.workflow))
+    wait_for_all(calls)
+
+def transition_with_update(plan, payload):
+    url = f"https://yoursite.atlassian.net/rest/api/3/issue/{plan.issue_key}/transitions"
+    headers = {
+        "Accept": "application/json",
+        "Content-Type": "application/json"
+    }
+    transition_id = get_completed_transition_id(plan.issue_key, plan.workflow)
+    for attempt in range(2):
+        if not transition_id:
+            return "Refused"
+        response = jira_session.post(url, json=dict(payload, transition={"id": transition_id}), headers=headers)
+        if response.status_code in [200, 204]:
+            print("Issue transitioned to Completed with its comment successfully!")
+            return "Done"
+        if response.status_code != 400:
+            print(f"Failed to transition issue: {response.status_code} - {response.text}")
+            return "Failed"
+        if refused_fields(response):
+            # The transition screen does not take these fields, the transition id is fine
+            print(f"Combined transition refused: {response.status_code} - {response.text}")
+            return "Refused fields"
+        # Otherwise the cached transition id is stale, e.g. after a workflow change
+        fresh_id = get_completed_transition_id(plan.issue_key, plan.workflow, refresh=True)
+        if fresh_id == transition_id:
+            break
+        transition_id = fresh_id
+    print(f"Combined transition refused: {response.status_code} - {response.text}")
+    return "Refused"
+
+def refused_fields(response):
+    # Jira names the fields it refuses in 'errors', a transition that is not available
+    # only shows up in 'errorMessages'
+    try:
+        return bool(response.json().get('errors'))
+    except (ValueError, AttributeError):
         return False
-    
-    
+
+def edit_issue(issue_key, payload):
+    url = f"https://yoursite.atlassian.net/rest/api/3/issue/{issue_key}"
+    headers = {
+        "Accept": "application/json",
+        "Content-Type": "application/json"
+    }
+    response = jira_session.put(url, json=payload, headers=headers)
+    if response.status_code in [200, 204]:
+        print("Issue updated successfully!")
+        return "Done"
+    if response.status_code == 400:
+        print(f"Combined issue update refused: {response.status_code} - {response.text}")
+        return "Refused"
+    print(f"Failed to update issue: {response.status_code} - {response.text}")
+    return "Failed"
+
+
 ## Function designed to post downloaded hyperlinks for both PDF and Word Doc into a comment ##
     # only runs if Total_Sum is GREATER than $4000 #
     
-def approved_quote(issue_key):
-    try:
-        url = f"https://yoursite.atlassian.net/rest/api/3/issue/{issue_key}?fields=attachment"
-        auth = connect_to_jira()
-        headers = {"Accept": "application/json"}
-        response = requests.get(url, headers=headers, auth=auth)
-        
-        if response.ok:
-            data = response.json()
-            attachments = data['fields']['attachment']
-            if attachments:
-                post_comment_to_jira(issue_key, attachments)
-                transition_issue_to_completed(issue_key)
-            else:
-                print("No attachments found for the issue.")
-        else:
-            print(f"Failed to get attachments: {response.status_code} {response.text}")
-    except Exception as e:
-        print(f"Error in approved_quote: {e}")
+def approved_quote(issue_key, attachments, workflow=None, job=None):
+    # attachments are the ones attach_documents_to_jira just created, older attachments
+    # on the issue are left out of the comment. Errors are raised, so the post_process
+    # stage fails and can be replayed.
+    if not attachments:
+        raise JobError(f"No attachments to link on {issue_key}")
+    run_jira_plan(JiraPlan(issue_key, comment=attachment_comment(issue_key, attachments),
+                           complete=True, workflow=workflow, job=job))
 
-def post_comment_to_jira(issue_key, attachments):
-    try:
-        url = f"https://yoursite.atlassian.net/rest/api/3/issue/{issue_key}/comment"
-        auth = connect_to_jira()
-        headers = {
-            "Accept": "application/json",
-            "Content-Type": "application/json"
-        }
-
-        # Prepare the body of the comment
-        body = {
-            "body": {
-                "version": 1,
-                "type": "doc",
+def attachment_comment(issue_key, attachments):
+    # Prepare the body of the comment
+    body = {
+        "version": 1,
+        "type": "doc",
+        "content": [
+            {
+                "type": "paragraph",
                 "content": [
                     {
-                        "type": "paragraph",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": "Your Quote has been successfully generated:"
-                            }
-                        ]
+                        "type": "text",
+                        "text": "Your Quote has been successfully generated:"
                     }
                 ]
             }
-        }
+        ]
+    }
 
-        # Append attachments to the comment
-        for attachment in attachments:
-            file_id = attachment['id']  # Correctly access the 'id' field of each attachment
-            file_name = attachment['filename']
-            media_item = {
-                "type": "mediaSingle",
-                "attrs": {"layout": "center"},
-                "content": [{
-                    "type": "media",
+    # Append attachments to the comment
+    for attachment in attachments:
+        file_id = attachment['id']  # Correctly access the 'id' field of each attachment
+        file_name = attachment['filename']
+        body['content'].append({
+            "type": "paragraph",
+            "content": [{
+                "type": "text",
+                "text": f"{file_name} - {file_id}",
+                "marks": [{
+                    "type": "link",
                     "attrs": {
-                        "type": "file",
-                        "id": file_id,
-                        "collection": issue_key
+                        "href": f"https://yoursite.atlassian.net/secure/attachment/{file_id}/{file_name}"
                     }
                 }]
-            }
-            body['body']['content'].append({
-                "type": "paragraph",
-                "content": [{
-                    "type": "text",
-                    "text": f"{file_name} - {file_id}",
-                    "marks": [{
-                        "type": "link",
-                        "attrs": {
-                            "href": f"https://yoursite.atlassian.net/secure/attachment/{file_id}/{file_name}"
-                        }
-                    }]
-                }]
-            })
-
-        # Send the comment post request
-        response = requests.post(url, json=body, headers=headers, auth=auth)
-        if response.status_code in [200, 201]:
-            print("Comment with attachments posted successfully!")
-        else:
-            print(f"Failed to post comment: {response.status_code} - {response.text}")
-
-    except Exception as e:
-        print(f"Error posting comment to JIRA: {e}")
+            }]
+        })
+    return body
         
 ## if approved quote runs then ticket status should transition to 'Completed' ##
         
-def get_completed_transition_id(issue_key):
+def get_completed_transition_id(issue_key, workflow=None, refresh=False):
+    key = workflow or workflow_key({'key': issue_key})
+    if refresh:
+        transition_id_cache.invalidate(key)
+    return transition_id_cache.get(key, lambda: lookup_completed_transition_id(issue_key))
+
+def lookup_completed_transition_id(issue_key):
     url = f"https://yoursite.atlassian.net/rest/api/3/issue/{issue_key}/transitions"
-    auth = connect_to_jira()
     headers = {"Accept": "application/json"}
-    response = requests.get(url, headers=headers, auth=auth)
+    response = jira_session.get(url, headers=headers)
 
     if response.ok:
         transitions = response.json().get('transitions', [])
@@ -571,11 +1876,12 @@ def get_completed_transition_id(issue_key):
                 return transition['id']
     return None
 
-def transition_issue_to_completed(issue_key):
-    transition_id = get_completed_transition_id(issue_key)
-    if transition_id:
+def transition_issue_to_completed(issue_key, workflow=None):
+    for attempt in range(2):
+        transition_id = get_completed_transition_id(issue_key, workflow, refresh=attempt > 0)
+        if not transition_id:
+            raise JobError(f"Transition ID for 'Completed' could not be found on {issue_key}")
         url = f"https://yoursite.atlassian.net/rest/api/3/issue/{issue_key}/transitions"
-        auth = connect_to_jira()
         headers = {
             "Accept": "application/json",
             "Content-Type": "application/json"
@@ -585,73 +1891,78 @@ def transition_issue_to_completed(issue_key):
                 "id": transition_id
             }
         }
-        response = requests.post(url, json=payload, headers=headers, auth=auth)
+        response = jira_session.post(url, json=payload, headers=headers)
         if response.status_code in [200, 204]:
             print("Issue transitioned to Completed successfully!")
-        else:
-            print(f"Failed to transition issue: {response.status_code} - {response.text}")
-    else:
-        print("Transition ID for 'Completed' could not be found.")
+            return
+        if response.status_code != 400 or attempt:
+            raise JobError(f"Failed to transition {issue_key}: {response.status_code} - {response.text}")
+        # The cached id is not valid from the issue's current status, look it up again
+        print(f"Transition {transition_id} was rejected for {issue_key}, refreshing the transition id.")
         
 
 ## IF total_sum is LESS than $4000 ##
-def needs_review(issue_key, total_sum, auth):
+def needs_review(issue_key, total_sum, job=None):
     if total_sum < 4000:
-        # Post a comment to the JIRA issue
-        post_comment(issue_key, "Due to policy, quote needs to be reviewed", auth)
-        # Assign the ticket to Nancy Galvez using her email
-        assign_ticket(issue_key, "ngalvez@yoursite.com", auth)
+        # Comment on the JIRA issue and assign it to Nancy Galvez using her email
+        run_jira_plan(JiraPlan(issue_key, comment=text_comment("Due to policy, quote needs to be reviewed"),
+                               assignee_email=REVIEW_ASSIGNEE_EMAIL, job=job))
+
+def text_comment(message):
+    return {
+        "version": 1,
+        "type": "doc",
+        "content": [{
+            "type": "paragraph",
+            "content": [{
+                "type": "text",
+                "text": message
+            }]
+        }]
+    }
 
-def post_comment(issue_key, message, auth):
+def post_adf_comment(issue_key, body):
     url = f"https://yoursite.atlassian.net/rest/api/3/issue/{issue_key}/comment"
     headers = {
         "Accept": "application/json",
         "Content-Type": "application/json"
     }
-    payload = {
-        "body": {
-            "version": 1,
-            "type": "doc",
-            "content": [{
-                "type": "paragraph",
-                "content": [{
-                    "type": "text",
-                    "text": message
-                }]
-            }]
-        }
-    }
-    response = requests.post(url, json=payload, headers=headers, auth=auth)
-    if response.status_code in [200, 201]:
-        print("Comment posted successfully!")
-    else:
-        print(f"Failed to post comment: {response.status_code} - {response.text}")
+    response = jira_session.post(url, json={"body": body}, headers=headers)
+    if response.status_code not in [200, 201]:
+        raise JobError(f"Failed to post comment on {issue_key}: {response.status_code} - {response.text}")
+    print("Comment posted successfully!")
 
-def get_account_id_by_email(email, auth):
+def get_account_id_by_email(email, refresh=False):
+    if refresh:
+        account_id_cache.invalidate(email)
+    return account_id_cache.get(email, lambda: lookup_account_id(email))
+
+def lookup_account_id(email):
     # Fetch accountId based on user's email
     url = f"https://yoursite.atlassian.net/rest/api/3/user/search?query={email}"
     headers = {"Accept": "application/json"}
-    response = requests.get(url, headers=headers, auth=auth)
+    response = jira_session.get(url, headers=headers)
     if response.status_code == 200 and response.json():
         return response.json()[0]['accountId']  # Assuming the first user returned is the correct one
     else:
         print(f"Failed to get accountId: {response.status_code} - {response.text}")
         return None
 
-def assign_ticket(issue_key, assignee_email, auth):
+def assign_ticket(issue_key, assignee_email):
     url = f"https://yoursite.atlassian.net/rest/api/3/issue/{issue_key}/assignee"
     headers = {
         "Accept": "application/json",
         "Content-Type": "application/json"
     }
-    payload = {
-        "accountId": get_account_id_by_email(assignee_email, auth)  # Fetch accountId based on user's email
-    }
-    response = requests.put(url, json=payload, headers=headers, auth=auth)
-    if response.status_code in [200, 204]:
-        print("Issue assigned successfully!")
-    else:
-        print(f"Failed to assign issue: {response.status_code} - {response.text}")
-
-
-
+    for attempt in range(2):
+        payload = {
+            "accountId": get_account_id_by_email(assignee_email, refresh=attempt > 0)  # Fetch accountId based on user's email
+        }
+        response = jira_session.put(url, json=payload, headers=headers)
+        if response.status_code in [200, 204]:
+            print("Issue assigned successfully!")
+            return
+        if response.status_code not in [400, 404] or attempt:
+            raise JobError(f"Failed to assign {issue_key}: {response.status_code} - {response.text}")
+        # The cached account may have been deactivated or replaced, look it up again
+        print(f"Account for {assignee_email} was rejected, refreshing the account id.")
@@ -0,0 +1,198 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+## SQLite job table ##
+# Every webhook payload is written here before any work starts, and each pipeline stage
+# is checkpointed as it completes. Rendered documents are kept in the artifacts table so
+# a job that is resumed after a crash does not have to render or convert them again.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    issue_key TEXT,
+    payload TEXT NOT NULL,
+    payload_hash TEXT,
+    status TEXT NOT NULL,
+    stages TEXT NOT NULL DEFAULT '{}',
+    outputs TEXT NOT NULL DEFAULT '{}',
+    result TEXT,
+    error TEXT,
+    owner TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE INDEX IF NOT EXISTS jobs_issue_key ON jobs (issue_key, payload_hash);
+CREATE TABLE IF NOT EXISTS instances (
+    id TEXT PRIMARY KEY,
+    heartbeat_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_artifacts (
+    job_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    content BLOB NOT NULL,
+    PRIMARY KEY (job_id, name)
+);
+'''
+
+# Jobs in these states have not finished and are picked up again after a restart
+UNFINISHED_STATUSES = ('debouncing', 'queued', 'running')
+
+# Stages whose output is a stored document rather than a checkpointed result
+ARTIFACT_STAGES = ('render', 'optimize_docx', 'convert', 'optimize_pdf')
+
+# Jobs are owned by a process instance, not a PID: a restarted container usually gets the
+# same PID again, and an unrelated process may reuse it. Every instance writes a heartbeat
+# to the instances table, and its jobs are orphaned once it has not done so for a lease.
+# The id contains a '-' so SQLite stores it as text in tables created with an INTEGER owner.
+def new_instance_id():
+    return f"{os.getpid()}-{uuid.uuid4().hex}"
+
+
+class JobStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._migrate()
+        self._conn.executescript(SCHEMA)
+
+    def _migrate(self):
+        # Job tables created before payload hashes were recorded
+        columns = [row['name'] for row in self._conn.execute('PRAGMA table_info(jobs)')]
+        if columns and 'payload_hash' not in columns:
+            self._conn.execute('ALTER TABLE jobs ADD COLUMN payload_hash TEXT')
+            self._conn.execute('DROP INDEX IF EXISTS jobs_issue_key')
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def save(self, job):
+        self._execute(
+            '''INSERT INTO jobs (id, issue_key, payload, payload_hash, status, stages, outputs, result, error, owner,
+                                 created_at, updated_at, finished_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (id) DO UPDATE SET
+                   issue_key = excluded.issue_key, payload = excluded.payload,
+                   payload_hash = excluded.payload_hash, status = excluded.status,
+                   stages = excluded.stages, outputs = excluded.outputs, result = excluded.result,
+                   error = excluded.error, owner = excluded.owner, updated_at = excluded.updated_at,
+                   finished_at = excluded.finished_at''',
+            (job.id, job.issue_key, json.dumps(job.data), job.payload_hash, job.status, json.dumps(job.stages),
+             json.dumps(job.outputs), job.result, job.error, job.owner, job.created_at, time.time(),
+             job.finished_at))
+
+    def load(self, job_id):
+        rows = self._execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        return self._record(rows[0]) if rows else None
+
+    def find_duplicate(self, issue_key, payload_hash, since):
+        # The issue's latest job, if it is for the same payload and has not failed. Older
+        # jobs do not count: after a field is edited and changed back, the quote for the
+        # restored payload has to be generated again.
+        rows = self._execute('SELECT * FROM jobs WHERE issue_key = ? ORDER BY created_at DESC LIMIT 1', (issue_key,))
+        if not rows:
+            return None
+        row = rows[0]
+        if row['payload_hash'] != payload_hash or row['status'] == 'failed' or row['created_at'] < since:
+            return None
+        return self._record(row)
+
+    def list(self, status=None, issue_key=None, since=None, limit=None):
+        sql = 'SELECT * FROM jobs WHERE 1 = 1'
+        params = []
+        if status:
+            sql += ' AND status = ?'
+            params.append(status)
+        if issue_key:
+            sql += ' AND issue_key = ?'
+            params.append(issue_key)
+        if since:
+            sql += ' AND created_at >= ?'
+            params.append(since)
+        sql += ' ORDER BY created_at'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return [self._record(row) for row in self._execute(sql, params)]
+
+    def heartbeat(self, instance_id):
+        self._execute('INSERT OR REPLACE INTO instances (id, heartbeat_at) VALUES (?, ?)', (instance_id, time.time()))
+
+    def owner_alive(self, owner, lease):
+        rows = self._execute('SELECT heartbeat_at FROM instances WHERE id = ?', (owner,))
+        return bool(rows) and rows[0]['heartbeat_at'] >= time.time() - lease
+
+    def claim_orphaned(self, owner, lease):
+        # Take over unfinished jobs whose owning instance has not sent a heartbeat within
+        # the lease. A job without an owner was written before jobs had one and is only
+        # taken once it has not been touched for a lease. The owner is compared again in
+        # the UPDATE so two instances recovering at once cannot both claim a job.
+        placeholders = ', '.join('?' for _ in UNFINISHED_STATUSES)
+        expired = time.time() - lease
+        rows = self._execute(f'''SELECT jobs.id, jobs.owner FROM jobs LEFT JOIN instances ON instances.id = jobs.owner
+                                 WHERE jobs.status IN ({placeholders}) AND jobs.owner IS NOT ?
+                                 AND (jobs.owner IS NOT NULL OR jobs.updated_at < ?)
+                                 AND (instances.heartbeat_at IS NULL OR instances.heartbeat_at < ?)''',
+                             UNFINISHED_STATUSES + (owner, expired, expired))
+        claimed = []
+        for row in rows:
+            with self._lock:
+                cursor = self._conn.execute('UPDATE jobs SET owner = ? WHERE id = ? AND owner IS ?',
+                                            (owner, row['id'], row['owner']))
+            if cursor.rowcount:
+                claimed.append(self.load(row['id']))
+        return claimed
+
+    def reset(self, job_id, owner, keep_checkpoints=True):
+        # Put a job back in the queue, owned by the instance that is going to run it, so no
+        # other instance recovers it in the meantime. Unless the checkpoints are kept it
+        # starts over from the first stage.
+        if keep_checkpoints:
+            self._execute('''UPDATE jobs SET status = 'queued', error = NULL, result = NULL, owner = ?,
+                             finished_at = NULL, updated_at = ? WHERE id = ?''', (owner, time.time(), job_id))
+        else:
+            self._execute('''UPDATE jobs SET status = 'queued', error = NULL, result = NULL, owner = ?,
+                             finished_at = NULL, stages = '{}', outputs = '{}', updated_at = ? WHERE id = ?''',
+                          (owner, time.time(), job_id))
+            self._execute('DELETE FROM job_artifacts WHERE job_id = ?', (job_id,))
+
+    def save_artifact(self, job_id, name, content):
+        self._execute('INSERT OR REPLACE INTO job_artifacts (job_id, name, content) VALUES (?, ?, ?)',
+                      (job_id, name, sqlite3.Binary(content)))
+
+    def load_artifact(self, job_id, name):
+        rows = self._execute('SELECT content FROM job_artifacts WHERE job_id = ? AND name = ?', (job_id, name))
+        return bytes(rows[0]['content']) if rows else None
+
+    def delete_artifacts(self, job_id):
+        self._execute('DELETE FROM job_artifacts WHERE job_id = ?', (job_id,))
+
+    def prune(self, cutoff, failed_artifacts_cutoff):
+        # Completed jobs are forgotten after the retention period. Failed ones are kept for
+        # replay, but their documents are dropped after failed_artifacts_cutoff, together
+        # with the checkpoints of the stages that produced them, so a replay renders again.
+        self._execute("DELETE FROM jobs WHERE status = 'completed' AND finished_at < ?", (cutoff,))
+        self._execute('DELETE FROM job_artifacts WHERE job_id NOT IN (SELECT id FROM jobs)')
+        self._execute('DELETE FROM instances WHERE heartbeat_at < ?', (cutoff,))
+        rows = self._execute('''SELECT id, stages FROM jobs WHERE status = 'failed' AND finished_at < ?
+                                AND id IN (SELECT job_id FROM job_artifacts)''', (failed_artifacts_cutoff,))
+        for row in rows:
+            stages = {name: stage for name, stage in json.loads(row['stages']).items()
+                      if name not in ARTIFACT_STAGES}
+            self._execute('UPDATE jobs SET stages = ? WHERE id = ?', (json.dumps(stages), row['id']))
+            self.delete_artifacts(row['id'])
+
+    def _record(self, row):
+        record = dict(row)
+        record['payload'] = json.loads(record['payload'])
+        record['stages'] = json.loads(record['stages'])
+        record['outputs'] = json.loads(record['outputs'])
+        return record
@@ -0,0 +1,125 @@
+import bisect
+import threading
+
+## Prometheus metrics ##
+# A small in-process registry rendered in the Prometheus text format on /metrics.
+# Histograms and counters are keyed by their label values. Gauges are read from a
+# callback when the metrics are scraped, so they never go stale.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+registry = []
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series['counts'][index] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def samples(self):
+        with self._lock:
+            series = sorted((key, dict(value, counts=list(value['counts']))) for key, value in self._series.items())
+        for key, value in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, value['counts']):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(self.labels, key, [('le', format_value(bound))])} {cumulative}"
+            yield f"{self.name}_bucket{format_labels(self.labels, key, [('le', '+Inf')])} {value['count']}"
+            yield f"{self.name}_sum{format_labels(self.labels, key)} {format_value(value['sum'])}"
+            yield f"{self.name}_count{format_labels(self.labels, key)} {value['count']}"
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+        registry.append(self)
+
+    def samples(self):
+        yield f"{self.name} {format_value(self.read())}"
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+## Quote pipeline metrics ##
+stage_duration = Histogram('quote_stage_duration_seconds', "Time spent in each quote job stage",
+                           ('stage', 'outcome'))
+job_duration = Histogram('quote_job_duration_seconds', "Time from the start of a quote job to its end", ('status',))
+jobs_finished = Counter('quote_jobs_total', "Quote jobs finished, by final status", ('status',))
+
+outbound_duration = Histogram('outbound_request_duration_seconds', "Duration of each call to Jira, Confluence and Graph",
+                              ('host', 'method', 'status'))
+outbound_retries = Counter('outbound_request_retries_total', "Outbound calls retried, by host and reason",
+                           ('host', 'reason'))
+rate_limit_wait = Histogram('outbound_rate_limit_wait_seconds', "Time calls waited for their host's rate limit",
+                            ('host',))
+
+request_duration = Histogram('http_request_duration_seconds', "Duration of requests handled by this app",
+                             ('endpoint', 'method', 'status'))
+
+output_bytes_saved = Counter('quote_output_bytes_saved_total', "Bytes removed from the documents before upload",
+                             ('document',))
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+## Rendered output cache ##
+# A quote is fully determined by its payload, the template, the date printed on it and
+# the settings it was post-processed with, so the rendered DOCX and PDF are stored on
+# disk under a hash of those. A webhook that fires again, or a batch run over issues
+# that did not change, gets its documents from here and goes straight to the uploads.
+# Entries are directories named after the key. Reading an entry touches it, and the
+# least recently used entries are removed once the cache grows past max_bytes.
+CACHE_FORMAT = 1  # bump when the renderer changes what it produces for the same inputs
+
+
+def output_key(payload_hash, template_version, today_date, options=None):
+    # options are the settings that change the output for the same inputs, e.g. the
+    # optimization applied before upload
+    key = f"{CACHE_FORMAT}:{payload_hash}:{template_version}:{today_date}:{json.dumps(options, sort_keys=True)}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class OutputCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> [size, last used]
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if key.startswith('.') or not os.path.isdir(path):
+                # Leftovers of writes interrupted by a crash
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                self._entries[key] = [size, os.stat(path).st_mtime]
+            except OSError:
+                continue
+
+    def get(self, key):
+        path = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(path, 'meta.json'), encoding='utf-8') as meta_file:
+                meta = json.load(meta_file)
+            with open(os.path.join(path, 'quote.docx'), 'rb') as word_file:
+                word_content = word_file.read()
+            with open(os.path.join(path, 'quote.pdf'), 'rb') as pdf_file:
+                pdf_content = pdf_file.read()
+        except (OSError, ValueError):
+            return None
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+        with self._lock:
+            if key in self._entries:
+                self._entries[key][1] = now
+        return word_content, pdf_content, meta
+
+    def put(self, key, word_content, pdf_content, meta):
+        size = len(word_content) + len(pdf_content)
+        if size > self.max_bytes:
+            return
+        # Written to a temporary directory first, so readers never see half an entry
+        work_dir = tempfile.mkdtemp(prefix='.', dir=self.directory)
+        try:
+            with open(os.path.join(work_dir, 'quote.docx'), 'wb') as word_file:
+                word_file.write(word_content)
+            with open(os.path.join(work_dir, 'quote.pdf'), 'wb') as pdf_file:
+                pdf_file.write(pdf_content)
+            with open(os.path.join(work_dir, 'meta.json'), 'w', encoding='utf-8') as meta_file:
+                json.dump(meta, meta_file)
+            os.chmod(work_dir, 0o755)
+            os.rename(work_dir, os.path.join(self.directory, key))
+        except OSError:
+            # Most likely another quote stored the same entry first
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return
+        with self._lock:
+            self._entries[key] = [size, time.time()]
+            self._evict()
+
+    def _evict(self):
+        # Called with the lock held
+        total = sum(size for size, _ in self._entries.values())
+        for key, (size, _) in sorted(self._entries.items(), key=lambda entry: entry[1][1]):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            del self._entries[key]
+            total -= size
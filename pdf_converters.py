@@ -0,0 +1,334 @@
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+## PDF conversion backends ##
+# Every backend takes the DOCX bytes and returns the PDF bytes. The platform specific
+# modules (docx2pdf/pythoncom on Windows, uno for LibreOffice) are only imported by the
+# backend that needs them, so selecting one backend never requires the others.
+
+class ConversionError(Exception):
+    pass
+
+
+class PdfConverter:
+    name = None
+
+    def start(self):
+        pass
+
+    def convert(self, word_content, timeout=None):
+        raise NotImplementedError
+
+    def health_check(self):
+        return True
+
+    def close(self):
+        pass
+
+
+def _write_docx(work_dir, word_content):
+    docx_path = os.path.join(work_dir, 'quote.docx')
+    with open(docx_path, 'wb') as docx_file:
+        docx_file.write(word_content)
+    return docx_path, os.path.join(work_dir, 'quote.pdf')
+
+def _read_pdf(pdf_path):
+    if not os.path.exists(pdf_path):
+        raise ConversionError("Converter did not produce a PDF")
+    with open(pdf_path, 'rb') as pdf_file:
+        return pdf_file.read()
+
+
+## Word through docx2pdf (Windows only) ##
+class Docx2PdfConverter(PdfConverter):
+    name = 'docx2pdf'
+
+    def __init__(self):
+        self._com_threads = threading.local()
+
+    def start(self):
+        # Loads the COM modules up front, and fails early where they are missing
+        try:
+            import pythoncom
+            import docx2pdf
+        except ImportError as e:
+            raise ConversionError(f"docx2pdf is not available: {e}")
+
+    def convert(self, word_content, timeout=None):
+        # Word cannot be interrupted, so the timeout is not enforced by this backend
+        import pythoncom
+        from docx2pdf import convert as docx_to_pdf_convert
+
+        # COM only has to be initialised once per thread, not for every document
+        if not getattr(self._com_threads, 'initialized', False):
+            pythoncom.CoInitialize()
+            self._com_threads.initialized = True
+
+        with tempfile.TemporaryDirectory(prefix='quote-') as work_dir:
+            docx_path, pdf_path = _write_docx(work_dir, word_content)
+            docx_to_pdf_convert(docx_path, pdf_path)
+            return _read_pdf(pdf_path)
+
+
+## One soffice process per document ##
+# Slow because every conversion pays for the LibreOffice startup, but it needs nothing
+# besides the soffice binary. Each run gets its own profile so conversions can overlap.
+class SofficeCliConverter(PdfConverter):
+    name = 'soffice'
+
+    def __init__(self, soffice_path='soffice', timeout=120):
+        self.soffice_path = soffice_path
+        self.timeout = timeout
+
+    def convert(self, word_content, timeout=None):
+        with tempfile.TemporaryDirectory(prefix='quote-') as work_dir:
+            docx_path, pdf_path = _write_docx(work_dir, word_content)
+            profile_url = 'file://' + os.path.join(work_dir, 'profile')
+            command = [self.soffice_path, '--headless', '--norestore', '--nolockcheck',
+                       f'-env:UserInstallation={profile_url}',
+                       '--convert-to', 'pdf', '--outdir', work_dir, docx_path]
+            try:
+                subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               timeout=timeout or self.timeout, check=True)
+            except subprocess.TimeoutExpired:
+                raise ConversionError("soffice timed out")
+            except (OSError, subprocess.CalledProcessError) as e:
+                raise ConversionError(f"soffice failed: {e}")
+            return _read_pdf(pdf_path)
+
+    def health_check(self):
+        return shutil.which(self.soffice_path) is not None
+
+
+## Pool of warm headless LibreOffice processes ##
+# Each worker is a long running soffice process with its own profile, listening on a
+# named pipe. Documents are handed to it over UNO, so the process startup is only paid
+# when a worker is started or recycled. Workers are replaced after max_jobs conversions,
+# when they die, and when a conversion runs past its timeout.
+class SofficeWorker:
+    def __init__(self, soffice_path, startup_timeout):
+        self.soffice_path = soffice_path
+        self.startup_timeout = startup_timeout
+        self.pipe_name = f"quote-converter-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.profile_dir = tempfile.mkdtemp(prefix='quote-soffice-')
+        self.process = None
+        self.desktop = None
+        self.jobs_done = 0
+
+    def start(self):
+        # Whatever goes wrong, the process and the profile are cleaned up and the caller
+        # gets a ConversionError
+        try:
+            self._start()
+        except ConversionError:
+            self.kill()
+            raise
+        except Exception as e:
+            self.kill()
+            raise ConversionError(f"LibreOffice worker did not start: {e}")
+
+    def _start(self):
+        import uno
+
+        self.process = subprocess.Popen(
+            [self.soffice_path, '--headless', '--invisible', '--nologo', '--norestore', '--nodefault',
+             '--nolockcheck', f'-env:UserInstallation=file://{self.profile_dir}',
+             f'--accept=pipe,name={self.pipe_name};urp;StarOffice.ComponentContext'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            'com.sun.star.bridge.UnoUrlResolver', local_context)
+        deadline = time.monotonic() + self.startup_timeout
+        while True:
+            try:
+                context = resolver.resolve(f'uno:pipe,name={self.pipe_name};urp;StarOffice.ComponentContext')
+                break
+            except Exception:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    raise ConversionError("LibreOffice worker did not start")
+                time.sleep(0.25)
+        self.desktop = context.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', context)
+
+    def is_alive(self):
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            self.desktop.getComponents()
+            return True
+        except Exception:
+            return False
+
+    def convert(self, docx_path, pdf_path):
+        import uno
+        from com.sun.star.beans import PropertyValue
+
+        def prop(name, value):
+            property_value = PropertyValue()
+            property_value.Name = name
+            property_value.Value = value
+            return property_value
+
+        document = self.desktop.loadComponentFromURL(
+            uno.systemPathToFileUrl(docx_path), '_blank', 0, (prop('Hidden', True), prop('ReadOnly', True)))
+        try:
+            document.storeToURL(uno.systemPathToFileUrl(pdf_path), (prop('FilterName', 'writer_pdf_Export'),))
+        finally:
+            document.close(True)
+        self.jobs_done += 1
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            try:
+                self.desktop.terminate()
+            except Exception:
+                pass
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+
+class LibreOfficeConverter(PdfConverter):
+    name = 'libreoffice'
+
+    def __init__(self, size=2, timeout=60, max_jobs=200, soffice_path='soffice', startup_timeout=30):
+        self.size = size
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.soffice_path = soffice_path
+        self.startup_timeout = startup_timeout
+        self._idle = queue.Queue()
+        self._workers = set()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        # The pool is only handed out once every worker is up. If one fails, the others are
+        # stopped and the next call to start() tries again.
+        workers = []
+        try:
+            for _ in range(self.size):
+                workers.append(self._new_worker())
+        except Exception:
+            with self._lock:
+                self._workers.difference_update(workers)
+                self._started = False
+            for worker in workers:
+                worker.stop()
+            raise
+        for worker in workers:
+            self._idle.put(worker)
+
+    def _new_worker(self):
+        worker = SofficeWorker(self.soffice_path, self.startup_timeout)
+        worker.start()
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _replace_worker(self, worker, kill=False):
+        # Bring the replacement up in the background so the current request is not held up
+        with self._lock:
+            self._workers.discard(worker)
+
+        def replace():
+            if kill:
+                worker.kill()
+            else:
+                worker.stop()
+            while True:
+                try:
+                    self._idle.put(self._new_worker())
+                    return
+                except Exception as e:
+                    print(f"Failed to start LibreOffice worker: {e}")
+                    time.sleep(5)
+
+        threading.Thread(target=replace, daemon=True).start()
+
+    def convert(self, word_content, timeout=None):
+        timeout = timeout or self.timeout
+        self.start()
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise ConversionError("No LibreOffice worker became free in time")
+
+        if not worker.is_alive():
+            self._replace_worker(worker, kill=True)
+            try:
+                worker = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                raise ConversionError("No LibreOffice worker became free in time")
+
+        healthy = False
+        try:
+            with tempfile.TemporaryDirectory(prefix='quote-') as work_dir:
+                docx_path, pdf_path = _write_docx(work_dir, word_content)
+                errors = []
+
+                def run():
+                    try:
+                        worker.convert(docx_path, pdf_path)
+                    except Exception as e:
+                        errors.append(e)
+
+                thread = threading.Thread(target=run, daemon=True)
+                thread.start()
+                thread.join(timeout)
+                if thread.is_alive():
+                    raise ConversionError(f"Conversion timed out after {timeout}s")
+                if errors:
+                    raise ConversionError(f"LibreOffice failed to convert the document: {errors[0]}")
+                pdf_content = _read_pdf(pdf_path)
+                healthy = True
+                return pdf_content
+        finally:
+            if not healthy:
+                self._replace_worker(worker, kill=True)
+            elif worker.jobs_done >= self.max_jobs:
+                self._replace_worker(worker)
+            else:
+                self._idle.put(worker)
+
+    def health_check(self):
+        with self._lock:
+            workers = list(self._workers)
+        return self._started and len(workers) == self.size and all(
+            worker.process is not None and worker.process.poll() is None for worker in workers)
+
+    def close(self):
+        with self._lock:
+            workers = list(self._workers)
+            self._workers.clear()
+        for worker in workers:
+            worker.stop()
+
+
+def create_converter(name, **options):
+    if name == 'docx2pdf':
+        return Docx2PdfConverter()
+    if name == 'libreoffice':
+        return LibreOfficeConverter(**options)
+    if name == 'soffice':
+        return SofficeCliConverter(options.get('soffice_path', 'soffice'), options.get('timeout', 120))
+    raise ValueError(f"Unknown PDF converter '{name}'")
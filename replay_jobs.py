@@ -0,0 +1,92 @@
+"""
+Replay quote jobs recorded in the SQLite job table.
+
+    python replay_jobs.py list --status failed
+    python replay_jobs.py replay --status failed --workers 4
+    python replay_jobs.py replay --job-id <job id> --from-scratch
+
+Replayed jobs resume from their last completed stage unless --from-scratch is given.
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from config import JOB_LEASE
+from flaskapp_script import INSTANCE_ID, QuoteJob, job_store, run_quote_job, start_heartbeat
+from job_store import UNFINISHED_STATUSES
+
+
+def parse_since(value):
+    return datetime.fromisoformat(value).timestamp()
+
+def select_jobs(args):
+    if args.job_id:
+        records = [job_store.load(job_id) for job_id in args.job_id]
+        missing = [job_id for job_id, record in zip(args.job_id, records) if record is None]
+        for job_id in missing:
+            print(f"Job {job_id} not found.")
+        return [record for record in records if record is not None]
+    return job_store.list(status=args.status, issue_key=args.issue, since=args.since, limit=args.limit)
+
+def list_jobs(args):
+    for record in select_jobs(args):
+        created = datetime.fromtimestamp(record['created_at']).strftime("%Y-%m-%d %H:%M:%S")
+        done = [name for name, stage in record['stages'].items() if stage.get('status') == 'completed']
+        print(f"{record['id']}  {record['issue_key']:<12} {record['status']:<10} {created}  "
+              f"stages done: {', '.join(done) or '-'}  {record['error'] or ''}")
+
+def replay_jobs(args):
+    records = [record for record in select_jobs(args) if record['status'] != 'completed' or args.job_id]
+    if not records:
+        print("No jobs to replay.")
+        return 0
+
+    # The jobs are taken over by this process, so it has to keep its heartbeat going
+    # for as long as it runs them. Jobs a live server is still running are left alone.
+    start_heartbeat()
+    jobs = []
+    for record in records:
+        if record['status'] in UNFINISHED_STATUSES and job_store.owner_alive(record['owner'], JOB_LEASE):
+            print(f"Skipping {record['id']}: still running on instance {record['owner']}.")
+            continue
+        job_store.reset(record['id'], INSTANCE_ID, keep_checkpoints=not args.from_scratch)
+        jobs.append(QuoteJob.from_record(job_store.load(record['id']), store=job_store))
+
+    if not jobs:
+        print("No jobs to replay.")
+        return 0
+    print(f"Replaying {len(jobs)} job(s) with {args.workers} worker(s)...")
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        results = list(executor.map(run_quote_job, jobs))
+
+    failed = [job for job in results if job.status != 'completed']
+    print(f"Replayed {len(results)} job(s) in {time.monotonic() - started:.1f}s, "
+          f"{len(results) - len(failed)} completed, {len(failed)} failed.")
+    for job in failed:
+        print(f"  {job.id}  {job.issue_key}: {job.error}")
+    return 1 if failed else 0
+
+def main():
+    parser = argparse.ArgumentParser(description="List and replay quote jobs from the job table.")
+    parser.add_argument('command', choices=['list', 'replay'])
+    parser.add_argument('--status', default=None, help="only jobs with this status, e.g. failed")
+    parser.add_argument('--issue', default=None, help="only jobs for this issue key")
+    parser.add_argument('--since', type=parse_since, default=None, help="only jobs created after this ISO date")
+    parser.add_argument('--job-id', action='append', default=[], help="a specific job id, can be repeated")
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--from-scratch', action='store_true', help="ignore checkpoints and rerun every stage")
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        list_jobs(args)
+        return 0
+    if not args.job_id and not args.status:
+        args.status = 'failed'
+    return replay_jobs(args)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
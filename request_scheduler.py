@@ -0,0 +1,210 @@
+import contextvars
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import outbound_duration, outbound_retries, rate_limit_wait
+
+## Outbound request scheduling ##
+# Every call to Jira, Confluence and Graph goes through a ScheduledAdapter. Each host
+# has a token bucket, so bursts of quotes queue up in the app instead of being answered
+# 429 by the tenant. Throttled and unavailable responses (429/503) are retried after
+# their Retry-After, which also pauses the host's bucket for everybody else. Other
+# transient failures are retried with jittered exponential backoff, as long as resending
+# the request is safe. No request waits, retries or stays in flight past the deadline
+# of the job it belongs to, and a request sent without a timeout gets default_timeout.
+RETRY_STATUSES = (429, 503)
+IDEMPOTENT_RETRY_STATUSES = (502, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+job_deadline = contextvars.ContextVar('job_deadline', default=None)
+
+
+class DeadlineExceeded(requests.exceptions.RequestException):
+    pass
+
+
+@contextmanager
+def deadline(seconds):
+    # Requests made inside the block, and by tasks it submits to a DeadlineExecutor,
+    # give up once the deadline has passed
+    token = job_deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        job_deadline.reset(token)
+
+def time_left():
+    expires_at = job_deadline.get()
+    return None if expires_at is None else expires_at - time.monotonic()
+
+
+class DeadlineExecutor(ThreadPoolExecutor):
+    # Runs every task under the deadline of the thread that submitted it
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # Take a token and return how long to wait before it may be used. The balance
+        # goes negative while requests are queued, and during a pause 'updated' lies in
+        # the future, so nothing is refilled until the pause is over.
+        with self._lock:
+            now = time.monotonic()
+            if now > self.updated:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+            self.tokens -= 1
+            return self.updated - now + max(-self.tokens, 0) / self.rate
+
+    def refund(self):
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+    def pause(self, seconds):
+        with self._lock:
+            now = time.monotonic()
+            if now > self.updated:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.tokens = min(self.tokens, 0)
+            self.updated = max(self.updated, now + seconds)
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler:
+    def __init__(self, rate_limits, default_rate_limit, max_retries=5, backoff_base=1, backoff_cap=60,
+                 default_timeout=60):
+        self.rate_limits = rate_limits
+        self.default_rate_limit = default_rate_limit
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.default_timeout = default_timeout
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, host):
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(*self.rate_limits.get(host, self.default_rate_limit))
+            return self._buckets[host]
+
+    def backoff(self, attempt):
+        # Full jitter, so retries from concurrent quotes do not line up
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def should_retry(self, request, status_code):
+        if status_code in RETRY_STATUSES:
+            return True
+        return status_code in IDEMPOTENT_RETRY_STATUSES and request.method in IDEMPOTENT_METHODS
+
+    def timeout(self, timeout):
+        # The caller's timeout, or the default, cut down to what is left of the job deadline.
+        # A (connect, read) tuple is cut down on both sides.
+        if timeout is None:
+            timeout = self.default_timeout
+        remaining = time_left()
+        if remaining is None:
+            return timeout
+        if isinstance(timeout, tuple):
+            return tuple(remaining if part is None else min(part, remaining) for part in timeout)
+        return min(timeout, remaining)
+
+    def send(self, send, request, **kwargs):
+        host = urlsplit(request.url).hostname
+        bucket = self.bucket(host)
+        caller_timeout = kwargs.get('timeout')
+        attempt = 0
+        response = None
+        while True:
+            wait = bucket.reserve()
+            remaining = time_left()
+            if remaining is not None and wait >= remaining:
+                bucket.refund()
+                if response is not None:
+                    # No time left to retry, the caller gets the last response instead
+                    return response
+                raise DeadlineExceeded(f"Job deadline passed before {request.method} {host} could be sent")
+            if wait > 0:
+                rate_limit_wait.observe(wait, host=host)
+                time.sleep(wait)
+
+            remaining = time_left()
+            if remaining is not None and remaining <= 0:
+                if response is not None:
+                    return response
+                raise DeadlineExceeded(f"Job deadline passed before {request.method} {host} could be sent")
+            kwargs['timeout'] = self.timeout(caller_timeout)
+
+            started = time.monotonic()
+            try:
+                response = send(request, **kwargs)
+            except requests.exceptions.RequestException as e:
+                outbound_duration.observe(time.monotonic() - started, host=host, method=request.method, status='error')
+                if not isinstance(e, requests.exceptions.ConnectionError):
+                    raise
+                # A connect timeout never reached the server, anything else may have
+                retryable = isinstance(e, requests.exceptions.ConnectTimeout) or request.method in IDEMPOTENT_METHODS
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                reason = f"failed ({e})"
+                outbound_retries.inc(host=host, reason='connection')
+            else:
+                outbound_duration.observe(time.monotonic() - started, host=host, method=request.method,
+                                          status=response.status_code)
+                if not self.should_retry(request, response.status_code) or attempt >= self.max_retries:
+                    return response
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if retry_after is not None and response.status_code in RETRY_STATUSES:
+                    bucket.pause(retry_after)
+                delay = retry_after if retry_after is not None else self.backoff(attempt)
+                reason = f"answered {response.status_code}"
+                outbound_retries.inc(host=host, reason=response.status_code)
+                # Read the body before the connection goes back to the pool, so the
+                # response can still be handed to the caller if the retry never happens
+                response.content
+                response.close()
+
+            remaining = time_left()
+            if remaining is not None and delay >= remaining:
+                if response is not None:
+                    return response
+                raise DeadlineExceeded(f"Job deadline passed while retrying {request.method} {host}")
+            print(f"{request.method} {host} {reason}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+class ScheduledAdapter(HTTPAdapter):
+    def __init__(self, scheduler, **kwargs):
+        self.scheduler = scheduler
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        return self.scheduler.send(super().send, request, **kwargs)
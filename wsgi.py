@@ -0,0 +1,7 @@
+from flaskapp_script import app, start_up
+
+## WSGI entry point ##
+# Serve the app through this module (e.g. `waitress-serve wsgi:app`) so every worker
+# warms up before it takes traffic. Render worker processes and the command line tools
+# import flaskapp_script directly and skip this.
+start_up()